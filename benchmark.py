@@ -0,0 +1,195 @@
+'''
+Time the critical paths of the launch start up against simulated devices
+
+Measures:
+- serial_check() round trip of a laser status query
+- run() time for a laser to reach power lock (s3)
+- EEPROM read throughput and sled decode time
+- LED writes per second straight to the i2c expanders, and for
+  set_active_leds() the calls per second, the bus transactions each call
+  costs and the delay until the LEDs are written
+
+Results are printed as JSON, so they can be saved and compared between
+versions, e.g.:
+
+    python benchmark.py --output before.json
+    python benchmark.py --baseline before.json
+'''
+
+from optparse import OptionParser
+from time import time, sleep, strftime
+from platform import python_version
+from json import dump, load
+import sys
+
+from devasys import Microcontroller
+from eeprom import EEPROM_SIZE
+from laser import Sapphire
+from simulator import SimulatedUsbI2cIo, SimulatedSapphire
+
+class Discard:
+  '''File-like sink for diagnostics printed during timing'''
+  def write(self, text):
+    pass
+
+def quiet(function, *args, **kwargs):
+  '''Call `function` with stdout discarded'''
+  stdout = sys.stdout
+  sys.stdout = Discard()
+  try:
+    return function(*args, **kwargs)
+  finally:
+    sys.stdout = stdout
+
+def summary(samples):
+  '''Statistics of a list of durations in seconds'''
+  samples = sorted(samples)
+  count = len(samples)
+  return {
+    'count': count,
+    'mean': sum(samples) / count,
+    'min': samples[0],
+    'median': samples[count // 2],
+    'p95': samples[min(count - 1, int(count * 0.95))],
+    'max': samples[-1],
+  }
+
+def timed(repeat, function, *args):
+  samples = []
+  for i in range(repeat):
+    start = time()
+    function(*args)
+    samples.append(time() - start)
+  return samples
+
+def bench_serial_check(options):
+  laser = Sapphire('SIM', SimulatedSapphire(latency=options.serial_latency))
+  query = laser.CHECK_STATUS
+  expected = laser.STATUS_OUTPUT
+  samples = quiet(timed, options.repeat, laser.serial_check, query, expected)
+  return summary(samples)
+
+def bench_run(options):
+  samples = []
+  for i in range(max(1, options.repeat // 100)):
+    laser = Sapphire('SIM', SimulatedSapphire(latency=options.serial_latency,
+                                             warmup=options.warmup))
+    start = time()
+    state = quiet(laser.run)
+    samples.append(time() - start)
+    if state != 's3':
+      return {'error': 'run() ended in state %s' % state}
+  result = summary(samples)
+  result['warmup'] = options.warmup
+  return result
+
+def board(options):
+  lib = SimulatedUsbI2cIo(latency=options.usb_latency,
+                          byte_time=options.byte_time)
+  return Microcontroller(cache_file=None, lib=lib), lib
+
+def bench_eeprom(options):
+  micro, lib = board(options)
+  transactions = lib.transactions
+  samples = timed(max(1, options.repeat // 100), micro.read_EEPROM_bulk,
+                  0, EEPROM_SIZE)
+  transactions = (lib.transactions - transactions) / len(samples)
+  sled = timed(max(1, options.repeat // 10), micro.read_sled_EEPROM)
+  micro.leds.close()
+  result = summary(samples)
+  result['bytes_per_second'] = EEPROM_SIZE / result['median']
+  result['transactions'] = transactions
+  result['sled_decode'] = summary(sled)
+  return result
+
+def bench_leds(options):
+  micro, lib = board(options)
+  values = [micro.all_ok_leds & ~mask for mask in micro.laser_led]
+  start = time()
+  for i in range(options.repeat):
+    micro.write_i2c_leds(values[i % len(values)])
+  direct = time() - start
+  # Time from set() until the background thread has written the LEDs
+  latency = []
+  for i in range(max(1, options.repeat // 10)):
+    value = values[(i % 2) * 2]
+    start = time()
+    micro.leds.set(value)
+    while micro.leds.shadow[0x42] != value >> 8 or \
+          micro.leds.shadow[0x40] != value & 0xFF:
+      sleep(0.0002)
+    latency.append(time() - start)
+  transactions = lib.transactions
+  start = time()
+  for i in range(options.repeat):
+    micro.set_active_leds(i % 5 + 1)
+  micro.leds.close()
+  coalesced = time() - start
+  return {
+    'writes_per_second': options.repeat / direct,
+    'set_active_leds_per_second': options.repeat / coalesced,
+    'bus_transactions_per_set':
+      float(lib.transactions - transactions) / options.repeat,
+    'set_to_bus': summary(latency),
+  }
+
+BENCHMARKS = (
+  ('serial_check', bench_serial_check),
+  ('run', bench_run),
+  ('eeprom', bench_eeprom),
+  ('leds', bench_leds),
+)
+
+def compare(results, baseline):
+  '''Print the change in median or rate of each benchmark'''
+  for name, result in sorted(results['benchmarks'].items()):
+    before = baseline.get('benchmarks', {}).get(name, {})
+    for key in ('median', 'bytes_per_second', 'writes_per_second',
+                'set_active_leds_per_second', 'bus_transactions_per_set'):
+      if key in result and key in before and before[key]:
+        print >> sys.stderr, '%-14s %-28s %+7.1f%%' % \
+          (name, key, 100.0 * (result[key] - before[key]) / before[key])
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='%prog [options] [benchmark ...]')
+  parser.add_option('--repeat', type='int', default=200,
+                    help='iterations of the fast benchmarks [%default]')
+  parser.add_option('--serial-latency', type='float', default=0.002,
+                    help='seconds for a laser to start replying [%default]')
+  parser.add_option('--usb-latency', type='float', default=0.001,
+                    help='seconds per DeVaSys transaction [%default]')
+  parser.add_option('--byte-time', type='float', default=90e-6,
+                    help='seconds per i2c byte [%default]')
+  parser.add_option('--warmup', type='float', default=1.0,
+                    help='seconds for a laser to reach power lock [%default]')
+  parser.add_option('--output', help='write JSON results to this file')
+  parser.add_option('--baseline', help='JSON results to compare against')
+  options, names = parser.parse_args()
+
+  results = {
+    'date': strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': python_version(),
+    'options': {
+      'repeat': options.repeat,
+      'serial_latency': options.serial_latency,
+      'usb_latency': options.usb_latency,
+      'byte_time': options.byte_time,
+      'warmup': options.warmup,
+    },
+    'benchmarks': {},
+  }
+  for name, benchmark in BENCHMARKS:
+    if not names or name in names:
+      results['benchmarks'][name] = benchmark(options)
+
+  if options.output is not None:
+    f = open(options.output, 'w')
+    dump(results, f, indent=2, sort_keys=True)
+    f.close()
+  else:
+    dump(results, sys.stdout, indent=2, sort_keys=True)
+    print
+  if options.baseline is not None:
+    f = open(options.baseline)
+    compare(results, load(f))
+    f.close()
@@ -7,117 +7,481 @@ Interfaces with Devasys microcontroller:
 - i2c control for front panel LEDs
 '''
 
-from ctypes import windll, c_ulong, pointer, create_string_buffer
-from struct import pack, unpack
+from ctypes import c_ulong, c_ubyte, c_ushort, Structure, pointer, byref, \
+                   memmove, string_at, addressof
 from sys import exit
+from threading import Thread, Lock, Event
+from time import time, sleep, strftime
+from os.path import expanduser, join
+from cPickle import dump, load
+from zlib import crc32
+from eeprom import SLED_START, SLED_END, BOARD_SERIAL_ADDRESS, \
+                   decode_sled, encode_field, read_image
+from metrics import METRICS
+
+I2C_MAX_TRANSFER = 256  # size of the I2C_TRANS data buffer
+I2C_TRANS_NOADR = 0x00  # no memory address cycle, e.g. LED expanders
+I2C_TRANS_8ADR = 0x01   # 8 bit memory address cycle
+I2C_TRANS_16ADR = 0x02  # 16 bit memory address cycle, e.g. EEPROM
+EEPROM_ADDRESS = 0xA2   # i2c address of EEPROM chip
+EEPROM_PAGE = 64        # bytes the EEPROM commits in one write cycle
+EEPROM_WRITE_TIMEOUT = 0.05 # seconds, the write cycle takes at most 5 ms
+DATE_MODIFIED = (0x2834, 11) # address and length of sled 'Date last modified'
+BOARD_SERIAL = (BOARD_SERIAL_ADDRESS, 16)
+EEPROM_CACHE = join(expanduser('~'), '.pyALC_eeprom.cache')
+INTERLOCK_INPUT = 0x40000 # B7
+SHUTTER_INPUT = 0x8000    # C6
+IO_INPUTS = {'interlock': INTERLOCK_INPUT, 'shutter': SHUTTER_INPUT}
+
+CACHE_LOCK = Lock() # serializes updates of the EEPROM cache by several boards
+
+def load_cache(cache_file):
+  '''Sleds cached by raw board serial number as (raw date modified, sled)'''
+  try:
+    f = open(cache_file,'rb')
+    try:
+      return load(f)
+    finally:
+      f.close()
+  except IOError:
+    return {} # no cache yet
+  except Exception:
+    print '(WW) Ignoring unreadable EEPROM cache:', cache_file
+    return {}
+
+def save_cache(cache_file, board, modified, sled):
+  '''Cache the `sled` of `board`, keeping the sleds of other boards'''
+  # Reread the cache, which other boards may have updated meanwhile
+  CACHE_LOCK.acquire()
+  try:
+    cache = load_cache(cache_file)
+    cache[board] = (modified, sled)
+    try:
+      f = open(cache_file,'wb')
+      try:
+        dump(cache, f, 2)
+      finally:
+        f.close()
+    except IOError:
+      print '(WW) Could not write EEPROM cache:', cache_file
+  finally:
+    CACHE_LOCK.release()
+
+class I2C_TRANS(Structure):
+  '''i2c transaction passed to DAPI_ReadI2c and DAPI_WriteI2c'''
+  _fields_ = [
+    ('byTransType', c_ubyte),
+    ('bySlvDevAddr', c_ubyte),
+    ('wMemoryAddr', c_ushort),
+    ('wCount', c_ushort),
+    ('Data', c_ubyte * I2C_MAX_TRANSFER),
+  ]
+
+def load_library():
+  '''DeVaSys usbi2cio.dll'''
+  from ctypes import windll
+  return windll.LoadLibrary('usbi2cio.dll')
+  # FIXME: handle library not found error
+
+def count_boards(lib=None):
+  '''Number of DeVaSys boards connected'''
+  if lib is None:
+    lib = load_library()
+  return lib.DAPI_GetDeviceCount('UsbI2cIo')
 
 class Usb2i2cio:
-  def __init__(self):
-    '''Instantiate DeVaSys board from library'''
-    self.lib = windll.LoadLibrary('usbi2cio.dll')
-    # FIXME: handle library not found error
-    self.handle = self.lib.DAPI_OpenDeviceInstance('UsbI2cIo', 0)
+  def __init__(self, lib=None, instance=0):
+    '''Instantiate DeVaSys board from library
+    
+    Pass `lib` to use another backend with the same DAPI functions as
+    usbi2cio.dll, e.g. simulator.SimulatedUsbI2cIo.  `instance` selects
+    one of several boards, counting from 0.
+    '''
+    if lib is None:
+      lib = load_library()
+    self.lib = lib
+    self.instance = instance
+    self.handle = self.lib.DAPI_OpenDeviceInstance('UsbI2cIo', instance)
     if self.handle is -1:
-      exit('(EE) DeVaSys board not found')
+      exit('(EE) DeVaSys board %d not found' % instance)
+    # Transaction buffer reused by every i2c read and write of this device
+    self.i2c_trans = I2C_TRANS()
+    self.p_i2c_trans = pointer(self.i2c_trans)
+    self.io_data = c_ulong()
+    self.i2c_lock = Lock() # serializes all USB transactions of the device
+  
+  def write_i2c_batch(self,transactions):
+    '''Write a list of i2c transactions in one go.
+    
+    Arguments:
+    transactions --
+      list or tuple of (byTransType, bySlvDevAddr, wMemoryAddr, data)
+      where data is a string of at most 256 bytes
+      e.g. [(I2C_TRANS_NOADR, 0x42, 0, '\\xdd')]
+    
+    Returns list of the number of bytes written by each transaction.
+    Raises ValueError, before anything is written, if any data does not
+    fit the transaction buffer.
+    '''
+    h = self.handle
+    dvs = self.lib
+    trans = self.i2c_trans
+    p_trans = self.p_i2c_trans
+    for transaction in transactions:
+      if len(transaction[3]) > len(trans.Data):
+        raise ValueError('(EE) %d bytes for 0x%04X do not fit the %d byte '
+                         'i2c buffer' % (len(transaction[3]), transaction[2],
+                                         len(trans.Data)))
+    written = []
+    self.i2c_lock.acquire()
+    try:
+      for byTransType, bySlvDevAddr, wMemoryAddr, data in transactions:
+        wCount = len(data)
+        trans.byTransType = byTransType
+        trans.bySlvDevAddr = bySlvDevAddr
+        trans.wMemoryAddr = wMemoryAddr
+        trans.wCount = wCount
+        memmove(trans.Data, data, wCount)
+        length_chk = dvs.DAPI_WriteI2c(h, p_trans)
+        if (length_chk != wCount):
+          print '(WW) WriteI2C(&i2c_Trans) failed,', \
+                length_chk, 'of', wCount, 'bytes written'
+        written.append(length_chk)
+    finally:
+      self.i2c_lock.release()
+    if METRICS.enabled:
+      METRICS.count('i2c_transactions_total', len(written),
+                    board=self.instance, direction='write')
+      METRICS.count('i2c_bytes_total', sum([max(length_chk, 0)
+                                            for length_chk in written]),
+                    board=self.instance, direction='write')
+    return written
+  
+  def read_i2c(self,byTransType,bySlvDevAddr,wMemoryAddr,wCount):
+    '''Read up to 256 bytes in a single i2c transaction'''
+    trans = self.i2c_trans
+    self.i2c_lock.acquire()
+    try:
+      trans.byTransType = byTransType
+      trans.bySlvDevAddr = bySlvDevAddr
+      trans.wMemoryAddr = wMemoryAddr
+      trans.wCount = wCount
+      length_chk = self.lib.DAPI_ReadI2c(self.handle, self.p_i2c_trans)
+      data = string_at(addressof(trans.Data), max(length_chk, 0))
+    finally:
+      self.i2c_lock.release()
+    if METRICS.enabled:
+      METRICS.count('i2c_transactions_total', board=self.instance,
+                    direction='read')
+      METRICS.count('i2c_bytes_total', len(data), board=self.instance,
+                    direction='read')
+    if (length_chk != wCount):
+      print 'ERR: ReadI2C(&i2c_Trans) failed,', \
+            length_chk, 'of', wCount, 'bytes read'
+    return data
   
   def write_i2c_leds(self,value):
     '''Write 2 bytes of LED data indicating laser fault and activity
     Write upper 1 byte to address 0x42
     Write lower 1 byte to address 0x40'''
-    h = self.handle
-    dvs = self.lib
-    byTransType = 0x00  # I2C_TRANS_NOADR
-    wCount = 1          # 2 bytes of zeroes, 1 byte of real information
-    format = 'BBHB'
-    for i in range(255):
-      format = format + 'x'
-    for (bySlvDevAddr, data) in ((0x42,value>>8), (0x40,value&0x00FF)):
-      packed_struct = pack(format,byTransType,bySlvDevAddr,wCount,data)
-      i2c_Trans = create_string_buffer(packed_struct, 260)
-      p_i2c_Trans = pointer(i2c_Trans)
-      length_chk = dvs.DAPI_WriteI2c(h, p_i2c_Trans)
-      if (length_chk != wCount):
-        print '(WW) WriteI2C(&i2c_Trans) failed,', \
-              length_chk, 'of', wCount, 'bytes written'
+    self.write_i2c_batch((
+      (I2C_TRANS_NOADR, 0x42, 0, chr(value>>8)),
+      (I2C_TRANS_NOADR, 0x40, 0, chr(value&0x00FF)),
+    ))
+  
+  def read_io_ports(self):
+    '''Levels of all I/O port pins, read in a single USB transaction'''
+    self.i2c_lock.acquire()
+    try:
+      self.lib.DAPI_ReadIoPorts(self.handle, byref(self.io_data))
+      return self.io_data.value
+    finally:
+      self.i2c_lock.release()
+  
+  def acknowledged(self,bySlvDevAddr):
+    '''True if the i2c device answers a single byte read'''
+    trans = self.i2c_trans
+    self.i2c_lock.acquire()
+    try:
+      trans.byTransType = I2C_TRANS_NOADR
+      trans.bySlvDevAddr = bySlvDevAddr
+      trans.wMemoryAddr = 0
+      trans.wCount = 1
+      return self.lib.DAPI_ReadI2c(self.handle, self.p_i2c_trans) == 1
+    finally:
+      self.i2c_lock.release()
+  
+  def wait_EEPROM_write(self,timeout=EEPROM_WRITE_TIMEOUT):
+    '''Poll until the EEPROM finished committing a page
+    
+    The EEPROM does not acknowledge its address during the write cycle, so
+    polling returns as soon as it is done instead of sleeping the worst
+    case write time.
+    '''
+    deadline = time() + timeout
+    while not self.acknowledged(EEPROM_ADDRESS):
+      if time() > deadline:
+        raise IOError('(EE) EEPROM still busy writing after %g s' % timeout)
+  
+  def write_EEPROM(self,start,data,current=None,verify=True):
+    '''Write `data` to the EEPROM from `start`, sending only changed bytes
+    
+    Changed bytes are grouped by EEPROM page, each page being written in a
+    single i2c transaction from its first to its last changed byte, since
+    a write crossing a page boundary wraps around within the page.  Pass
+    the `current` EEPROM contents from `start` if already read.  With
+    `verify` the ranges written are read back and their CRC-32 compared to
+    that of the data sent.
+    
+    Returns the number of pages written.
+    '''
+    if current is None:
+      current = self.read_EEPROM_bulk(start, len(data))
+    if len(current) != len(data):
+      raise IOError('(EE) Could not read EEPROM before writing')
+    transactions = []
+    end = start + len(data)
+    page = start - start % EEPROM_PAGE
+    while page < end:
+      changed = [i for i in range(max(page, start) - start,
+                                  min(page + EEPROM_PAGE, end) - start)
+                 if data[i] != current[i]]
+      if changed:
+        first, last = changed[0], changed[-1] + 1
+        transactions.append((I2C_TRANS_16ADR, EEPROM_ADDRESS,
+                             start + first, data[first:last]))
+      page = page + EEPROM_PAGE
+    for transaction in transactions:
+      written = self.write_i2c_batch((transaction,))
+      if written[0] != len(transaction[3]):
+        raise IOError('(EE) EEPROM write at 0x%04X failed' % transaction[2])
+      self.wait_EEPROM_write()
+    if verify and transactions:
+      sent = 0
+      readback = 0
+      for byTransType, bySlvDevAddr, wMemoryAddr, chunk in transactions:
+        sent = crc32(chunk, sent)
+        readback = crc32(self.read_EEPROM_bulk(wMemoryAddr, len(chunk)),
+                         readback)
+      if readback != sent:
+        raise IOError('(EE) EEPROM verify of 0x%04X-0x%04X failed' %
+                      (transactions[0][2],
+                       transactions[-1][2] + len(transactions[-1][3])))
+    return len(transactions)
   
   def read_EEPROM(self,start,length,save_file=None,BCD=False):
     '''Get available lasers by reading EEPROM using i2c'''
-    data = ''
+    data = self.read_EEPROM_bulk(start,length)
     if save_file is not None:
-      print '(II) Saving raw data to file:', file
+      print '(II) Saving raw data to file:', save_file
       f = open(save_file,'wb')
-    h = self.handle
-    dvs = self.lib
-    '''
-    Pack the I2C_TRANS struct with the following:
-    - BYTE byTransType
-    - BYTE bySlvDevAddr
-    - WORD wMemoryAddr
-    - WORD wCount
-    - BYTE Data[256]
+      f.write(data)
+      f.close()
+      return data
+    if BCD:
+      return ''.join(str(ord(c)) for c in data)
+    clip = data.find('\x00')
+    if clip is not -1:
+      data = data[0:clip]
+    return data
+  
+  def read_EEPROM_bulk(self,start,length):
+    '''Read raw EEPROM bytes using as few i2c transactions as possible
+    
+    Each transaction reads a full I2C_TRANS data buffer of 256 bytes
+    instead of 64, and the string returned is not clipped or decoded.
     '''
-    byTransType = 0x02  # I2C_TRANS_16ADR
-    #print 'DBG: byTransType =', hex(byTransType), type(byTransType), \
-    #      'Read or write 16 bit address cycle'
-    bySlvDevAddr = 0xA2 # EEPROM chip
-    #print 'DBG: bySlvDevAddr =', hex(bySlvDevAddr), type(bySlvDevAddr), \
-    #      'i2C address of EEPROM chip'
+    timed = METRICS.enabled # read once, it may be switched on meanwhile
+    if timed:
+      started = time()
+    chunks = []
     wMemoryAddr = start
-    #print 'DBG: wMemoryAddr =', hex(wMemoryAddr), type(wMemoryAddr), \
-    #      'Read address on EEPROM chip'
-    increment = 64
-    loops = length / increment
-    total_loops = loops
-    loop_remainder = length % increment
-    while (loops + 1):
-      if loops == 0:
-        wCount = loop_remainder
-      else:
-        print 'DBG: Loop', total_loops - loops + 1, 'of', total_loops
-        wCount = increment
-      loops = loops - 1
-      #print 'DBG: wCount =', wCount, type(wCount), \
-      #      'Number of bytes to read'
-      format = 'BBHH'
-      for i in range(256):
-        format = format + 'x'
-      packed_struct = pack(format,byTransType,bySlvDevAddr,wMemoryAddr,wCount)
-      i2c_Trans = create_string_buffer(packed_struct, 262)
-      p_i2c_Trans = pointer(i2c_Trans)
-      length_chk = dvs.DAPI_ReadI2c(h, p_i2c_Trans)
-      if (length_chk == wCount):
-        #print 'DBG: ReadI2C(&i2c_Trans) successful,', length, 'bytes read'
-        if save_file is not None:
-          #print 'DBG: Format =', format
-          f.write(i2c_Trans[6:increment+6])
-        else:
-          format = 'BBHH'
-          for i in range(wCount):
-            if BCD is False:
-              format = format + 'c'
-            else:
-              format = format + 'B'
-          for i in range(256 - wCount):
-            format = format + 'x'
-          hex_data = list(unpack(format, i2c_Trans)[4:])
-          try: clip = hex_data.index('\x00')
-          except ValueError: clip = -1 # No value to remove
-          if clip is not -1:
-            hex_data = hex_data[0:clip]
-          hex_data = ''.join(str(s) for s in hex_data)
-      else:
-        print 'ERR: ReadI2C(&i2c_Trans) failed,', \
-              length_chk, 'of', wCount, 'bytes read'
-      if (loops >= 0):
-        wMemoryAddr = wMemoryAddr + increment
-        #print 'DBG: wMemoryAddr =', hex(wMemoryAddr), type(wMemoryAddr), \
-        #      'Read address on EEPROM chip'
-    return hex_data
+    end = start + length
+    while wMemoryAddr < end:
+      wCount = min(I2C_MAX_TRANSFER, end - wMemoryAddr)
+      chunk = self.read_i2c(I2C_TRANS_16ADR, EEPROM_ADDRESS,
+                            wMemoryAddr, wCount)
+      chunks.append(chunk)
+      if len(chunk) != wCount:
+        break
+      wMemoryAddr = wMemoryAddr + wCount
+    if timed:
+      METRICS.observe('eeprom_read_seconds', time() - started,
+                      board=self.instance)
+    return ''.join(chunks)
+
+class LedController:
+  '''Front panel LEDs written through shadow copies of the i2c expanders
+  
+  Only expander bytes which differ from the value last written go out on
+  the bus.  Updates are handed to a background thread which writes the
+  latest one at most once every `interval` seconds, so bursts of activity
+  changes are merged and the caller never waits on the bus.
+  '''
+  def __init__(self, device, interval=0.05):
+    self.device = device
+    self.interval = interval
+    self.shadow = {0x42: None, 0x40: None} # unknown until first write
+    self.pending = None
+    self.lock = Lock()       # guards pending and shadow, never held on the bus
+    self.flushing = Lock()   # one flush at a time, so writes stay in order
+    self.wake = Event()
+    self.running = True
+    self.thread = Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+  
+  def set(self, value):
+    '''Queue 2 bytes of LED data to be written by the background thread'''
+    self.lock.acquire()
+    self.pending = value
+    self.lock.release()
+    self.wake.set()
+  
+  def flush(self):
+    '''Write the queued LED data now, skipping unchanged expander bytes
+    
+    The bus is written without holding the lock of set(), so callers never
+    wait on a USB transaction.
+    '''
+    self.flushing.acquire()
+    try:
+      self.lock.acquire()
+      try:
+        value = self.pending
+        self.pending = None
+        if value is None:
+          return
+        transactions = []
+        for bySlvDevAddr, data in ((0x42, value>>8), (0x40, value&0x00FF)):
+          if self.shadow[bySlvDevAddr] != data:
+            transactions.append((I2C_TRANS_NOADR, bySlvDevAddr, 0,
+                                 chr(data)))
+      finally:
+        self.lock.release()
+      if not transactions:
+        return
+      written = self.device.write_i2c_batch(transactions)
+      self.lock.acquire()
+      try:
+        for (byTransType, bySlvDevAddr, wMemoryAddr, data), length_chk in \
+            zip(transactions, written):
+          if length_chk == 1:
+            self.shadow[bySlvDevAddr] = ord(data)
+          else:
+            self.shadow[bySlvDevAddr] = None # rewrite next time
+      finally:
+        self.lock.release()
+    finally:
+      self.flushing.release()
+  
+  def run(self):
+    '''Background loop writing LED updates no faster than `interval`'''
+    while self.running:
+      self.wake.wait()
+      self.wake.clear()
+      self.flush()
+      sleep(self.interval)
+  
+  def close(self):
+    '''Write any queued LED data and stop the background thread'''
+    self.running = False
+    self.wake.set()
+    self.thread.join()
+    self.flush()
+
+class IoMonitor:
+  '''Watch input pins of the DeVaSys board for level changes
+  
+  A background thread samples every input with one DAPI_ReadIoPorts call
+  each `interval` seconds, so an interlock trip is seen within
+  milliseconds rather than at the next status poll of every laser.  Each
+  edge calls `callback(name, level, when)` and, if given, is put on
+  `queue` as the tuple (name, level, when), where level is True when the
+  pin went high.
+  
+  Arguments:
+  device -- opened Usb2i2cio, with the pins configured as inputs, e.g. by
+    Microcontroller.bypass()
+  inputs -- dictionary of name: pin mask to watch
+  '''
+  def __init__(self, device, callback=None, queue=None, interval=0.002,
+               inputs=IO_INPUTS):
+    self.device = device
+    self.callback = callback
+    self.queue = queue
+    self.interval = interval
+    self.inputs = inputs
+    self.mask = 0
+    for mask in inputs.values():
+      self.mask = self.mask | mask
+    self.data = None # pin levels of the last sample
+    self.samples = 0
+    self.running = False
+    self.thread = None
+  
+  def level(self, name):
+    '''Last level sampled of input `name`, or None before sampling'''
+    if self.data is None:
+      return None
+    return bool(self.data & self.inputs[name])
+  
+  def sample(self):
+    '''Read the inputs once, reporting any edges since the last sample'''
+    data = self.device.read_io_ports() & self.mask
+    when = time()
+    self.samples = self.samples + 1
+    previous = self.data
+    self.data = data
+    if previous is None or data == previous:
+      return
+    changed = data ^ previous
+    for name, mask in self.inputs.items():
+      if changed & mask:
+        level = bool(data & mask)
+        if self.callback is not None:
+          self.callback(name, level, when)
+        if self.queue is not None:
+          self.queue.put((name, level, when))
+  
+  def run(self):
+    while self.running:
+      try:
+        self.sample()
+      except Exception, error:
+        print '(EE) Reading I/O ports failed:', error
+      sleep(self.interval)
+  
+  def start(self):
+    '''Take a first sample of the levels and start watching'''
+    self.sample()
+    self.running = True
+    self.thread = Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+  
+  def stop(self):
+    self.running = False
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
 
 class Microcontroller(Usb2i2cio):
-  def __init__(self):
-    Usb2i2cio.__init__(self)
-    self.read_sled_EEPROM()
+  def __init__(self, cache_file=EEPROM_CACHE, lib=None, read_sled=True,
+               instance=0):
+    '''Open the DeVaSys board and identify the sled.
+    
+    Set `cache_file` to None to always decode the sled EEPROM in full, or
+    `read_sled` to False to leave reading the sled to the caller.
+    '''
+    Usb2i2cio.__init__(self, lib, instance)
+    self.cache_file = cache_file
+    self.eeprom = None
+    if read_sled:
+      if cache_file is None:
+        self.read_sled_EEPROM()
+      else:
+        self.read_sled_EEPROM_cached(cache_file)
     
     self.laser_led = (
       # masks for the 5 front panel LED
@@ -129,6 +493,7 @@ class Microcontroller(Usb2i2cio):
     )
     
     self.all_ok_leds = 0xDDB6
+    self.leds = LedController(self)
   
   def set_active_leds(self, *lasers):
     '''Set any combination of 5 laser as active.
@@ -138,10 +503,9 @@ class Microcontroller(Usb2i2cio):
     
     for laser in lasers:
       if isinstance(laser, int) and laser >=1 and laser <=5:
-        leds = leds - self.laser_led[laser - 1]
+        leds = leds & ~self.laser_led[laser - 1]
     
-    print hex(leds)
-    self.write_i2c_leds(leds)
+    self.leds.set(leds)
   
   def bypass(self):
     '''Defeat laser interlocks and open safety shutter'''
@@ -149,64 +513,86 @@ class Microcontroller(Usb2i2cio):
     dvs = self.lib
     ioconf = c_ulong(0x48000) # B7, C6 = inputs, rest = outputs
     iodata = c_ulong(0x84000) # B6, C7 high, others low
-    dvs.DAPI_ConfigIoPorts(h, ioconf)
-    iomask = 0x80000 # B6 high only: defeat laser safety interlocks
-    dvs.DAPI_WriteIoPorts(h, iodata, iomask)
-    iomask = 0x4000  # C7 high only: open safety shutter located after AOTF
-    dvs.DAPI_WriteIoPorts(h, iodata, iomask)
+    self.i2c_lock.acquire() # the sled may be read at the same time
+    try:
+      dvs.DAPI_ConfigIoPorts(h, ioconf)
+      iomask = 0x80000 # B6 high only: defeat laser safety interlocks
+      dvs.DAPI_WriteIoPorts(h, iodata, iomask)
+      iomask = 0x4000  # C7 high only: open safety shutter located after AOTF
+      dvs.DAPI_WriteIoPorts(h, iodata, iomask)
+    finally:
+      self.i2c_lock.release()
   
   def start_laser(self):
     '''Start up laser using i2c, e.g. Cobolt Compass 561nm'''
     pass
     
   def read_sled_EEPROM(self,read_file=None):
-    h = self.handle
-    dvs = self.lib
-    LASER_OFFSET = 0x80
-    EEPROM_MAPPING = (
-      ('EEPROM_VERSION', 0x2815, 1),
-      ('SERIAL', 0x283F, 10),
-      ('LASERS_BCD', 0x2857, 1),
-      ('L1_WAVELENGTH', 0x2890, 3),
-      ('L1_POWER', 0x2893, 3),
-      ('L1_FAMILY', 0x28A0, 16),
-    )
-    self.eeprom = {}
-    sled = self.eeprom
-    if read_file is not None:
-      f = open(read_file,'r')
-    for property, address, length in EEPROM_MAPPING:
-      if read_file is not None:
-        f.seek(address)
-        data = f.read(length)
-      else:
-        if property.find('_BCD') is not -1:
-          data = self.read_EEPROM(address,length,BCD=True)
-        else:
-          data = self.read_EEPROM(address,length,BCD=False)
-      try:
-        data = int(data)
-      except ValueError:
-        pass # leave as string
-      sled[property] = data
-    i = 2
-    while i <= sled['LASERS_BCD']:
-      for property, address, length in EEPROM_MAPPING:
-        if read_file is not None:
-          f.seek(address + LASER_OFFSET * (i-1))
-          data = f.read(length)
-        else:
-          data = self.read_EEPROM(address + LASER_OFFSET * (i-1),length)
-        if property.find('L1_') is not -1:
-          try:
-            data = int(data)
-          except ValueError:
-            pass
-          sled['L'+str(i)+property.lstrip('L1')] = data
-      i = i + 1
+    '''Identify the lasers installed from the sled metadata
+    
+    The whole metadata region is read in one bulk dump, or a saved EEPROM
+    image `read_file` is memory mapped, and decoded in a single pass.
+    Raises IOError if the dump comes back short.
+    '''
     if read_file is not None:
-      f.close()
+      self.eeprom = read_image(read_file)
+    else:
+      image = self.read_EEPROM_bulk(SLED_START, SLED_END - SLED_START)
+      if len(image) != SLED_END - SLED_START:
+        raise IOError('(EE) Could not read the sled EEPROM, %d of %d bytes' %
+                      (len(image), SLED_END - SLED_START))
+      self.eeprom = decode_sled(image, SLED_START)
+    return self.eeprom
+  
+  def read_sled_EEPROM_cached(self,cache_file=EEPROM_CACHE):
+    '''Identify the lasers installed, reusing the sled decoded previously
+    
+    Only the board serial number and the sled 'Date last modified' are read
+    from the EEPROM.  The sled is decoded in full and `cache_file` updated
+    only if this board is not cached or its sled was modified since.  A
+    failed or blank read of either field skips the cache altogether.
+    '''
+    board = self.read_EEPROM_bulk(*BOARD_SERIAL)
+    modified = self.read_EEPROM_bulk(*DATE_MODIFIED)
+    if not board.strip('\x00\xff ') or not modified.strip('\x00\xff '):
+      print '(WW) Board serial or sled date not readable, not using the cache'
+      return self.read_sled_EEPROM()
+    cache = load_cache(cache_file)
+    if cache.get(board, (None,))[0] == modified:
+      self.eeprom = cache[board][1]
+      return self.eeprom
+    
+    sled = self.read_sled_EEPROM()
+    save_cache(cache_file, board, modified, sled)
     return sled
+  
+  def update_sled(self,fields,modified=None):
+    '''Write sled fields named as in `eeprom`, e.g. {'L2_AOTF_MHZ': 101.25}
+    
+    Only the bytes which change are written.  The sled 'Date last
+    modified' is set to `modified`, by default today, unless given in
+    `fields`.  Returns the sled decoded from the new EEPROM contents.
+    '''
+    fields = dict(fields)
+    fields.setdefault('DATE_MODIFIED', modified or strftime('%Y/%m/%d'))
+    current = self.read_EEPROM_bulk(SLED_START, SLED_END - SLED_START)
+    if len(current) != SLED_END - SLED_START:
+      raise IOError('(EE) Could not read the sled EEPROM before writing')
+    image = bytearray(current)
+    for property, value in fields.items():
+      address, data = encode_field(property, value)
+      if address < SLED_START or address + len(data) > SLED_END:
+        raise ValueError('(EE) %s is not part of the sled' % property)
+      image[address - SLED_START:address - SLED_START + len(data)] = data
+    image = str(image)
+    self.write_EEPROM(SLED_START, image, current)
+    self.eeprom = decode_sled(image, SLED_START)
+    if self.cache_file is not None:
+      address, length = DATE_MODIFIED
+      save_cache(self.cache_file, self.read_EEPROM_bulk(*BOARD_SERIAL),
+                 image[address - SLED_START:address - SLED_START + length],
+                 self.eeprom)
+    return self.eeprom
 
 if __name__ == '__main__':
   '''
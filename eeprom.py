@@ -0,0 +1,185 @@
+'''
+Decode Andor laser sled metadata from EEPROM images
+
+The sled layout is declared as tables of fields which are compiled once into
+`struct.Struct` objects, so a sled is decoded with one `unpack_from` call for
+the header and one for each 0x80 byte laser record, straight from the buffer
+holding the image: a string read from the DeVaSys board, or a memory mapped
+EEPROM dump.
+'''
+
+from struct import Struct
+from mmap import mmap, ACCESS_READ
+from re import compile
+
+SLED_START = 0x2800     # Andor laser sled metadata
+SLED_END = 0x3180
+LASER_START = 0x2880    # Record of laser 1
+LASER_OFFSET = 0x80     # Stride of laser records
+MAX_LASERS = 6
+BOARD_SERIAL_ADDRESS = 0x3F00
+EEPROM_SIZE = 0x4000
+
+# Fields as (property, address, struct format, kind) where kind is one of
+#   'text'    -- ASCII clipped at the first NUL or unwritten 0xFF byte,
+#                converted to int where possible
+#   'bcd'     -- single binary byte, e.g. 0x04
+#   'decimal' -- ASCII digits before and after the decimal point
+SLED_LAYOUT = (
+  ('MANUFACTURER', 0x2801, '16s', 'text'),
+  ('EEPROM_VERSION', 0x2815, '1s', 'text'),
+  ('MODEL', 0x281F, '10s', 'text'),
+  ('DATE_MANUFACTURED', 0x2829, '11s', 'text'),
+  ('DATE_MODIFIED', 0x2834, '11s', 'text'),
+  ('SERIAL', 0x283F, '10s', 'text'),
+  ('LASERS_BCD', 0x2857, 'B', 'bcd'),
+)
+# Addresses of laser 1, the other lasers follow every LASER_OFFSET bytes
+LASER_LAYOUT = (
+  ('MODEL', 0x2880, '16s', 'text'),
+  ('WAVELENGTH', 0x2890, '3s', 'text'),
+  ('POWER', 0x2893, '3s', 'text'),
+  ('AOTF_MHZ', 0x2897, '3s3s', 'decimal'),
+  ('AOTF_DB', 0x289D, '2s1s', 'decimal'),
+  ('FAMILY', 0x28A0, '16s', 'text'),
+)
+BOARD_LAYOUT = (
+  ('BOARD_SERIAL', BOARD_SERIAL_ADDRESS, '16s', 'text'),
+)
+LASER_PROPERTY = compile(r'^L(\d)_(\w+)$') # e.g. 'L2_FAMILY'
+
+def text(data):
+  '''ASCII field clipped at its terminator, as int if it is a number'''
+  for terminator in ('\x00', '\xff'):
+    clip = data.find(terminator)
+    if clip is not -1:
+      data = data[0:clip]
+  try:
+    return int(data)
+  except ValueError:
+    return data # leave as string
+
+def decimal(whole, fraction):
+  '''Number stored as ASCII digits either side of the decimal point'''
+  try:
+    return float(whole + '.' + fraction)
+  except ValueError:
+    return None # field never written
+
+class Layout:
+  '''Table of EEPROM fields compiled into a single struct'''
+  def __init__(self, fields, origin):
+    '''Compile `fields` with addresses relative to `origin`'''
+    self.origin = origin
+    self.fields = []
+    format = '<'
+    position = origin
+    for property, address, field_format, kind in \
+        sorted(fields, key=lambda field: field[1]):
+      if address > position:
+        format = format + '%dx' % (address - position)
+      field = Struct('<' + field_format)
+      format = format + field_format
+      position = address + field.size
+      values = len(field.unpack('\x00' * field.size))
+      self.fields.append((property, values, kind))
+    self.struct = Struct(format)
+    self.size = self.struct.size
+
+  def decode(self, buffer, offset=0, prefix=''):
+    '''Return dictionary of fields of the record at `offset` of `buffer`'''
+    values = self.struct.unpack_from(buffer, offset)
+    record = {}
+    i = 0
+    for property, count, kind in self.fields:
+      if kind == 'text':
+        data = text(values[i])
+      elif kind == 'decimal':
+        data = decimal(*values[i:i + count])
+      else:
+        data = values[i]
+      record[prefix + property] = data
+      i = i + count
+    return record
+
+SLED = Layout(SLED_LAYOUT, SLED_START)
+LASER = Layout(LASER_LAYOUT, LASER_START)
+BOARD = Layout(BOARD_LAYOUT, BOARD_SERIAL_ADDRESS)
+
+def encode_field(property, value):
+  '''Address and bytes to write to set sled field `property` to `value`
+  
+  `property` is named as by decode_sled(), e.g. encode_field('L2_AOTF_MHZ',
+  101.25) returns (0x2917, '101250').  Numbers written to text fields are
+  zero padded to the field width like Andor's images, e.g. a POWER of 50
+  becomes '050', and shorter text is NUL filled to the end of the field so
+  no tail of the old value is left behind.
+  '''
+  match = LASER_PROPERTY.match(property)
+  offset = 0
+  if match is not None:
+    laser, name = int(match.group(1)), match.group(2)
+    if not 1 <= laser <= MAX_LASERS:
+      raise KeyError(property)
+    layout = LASER_LAYOUT
+    offset = LASER_OFFSET * (laser - 1)
+  else:
+    name = property
+    layout = SLED_LAYOUT + BOARD_LAYOUT
+  for field, address, format, kind in layout:
+    if field == name:
+      break
+  else:
+    raise KeyError(property)
+  size = Struct('<' + format).size
+  if kind == 'bcd':
+    data = chr(value)
+  elif kind == 'decimal':
+    whole_size, fraction_size = [int(part)
+                                 for part in format.split('s')[:2]]
+    scale = 10 ** fraction_size
+    whole, fraction = divmod(int(round(value * scale)), scale)
+    data = '%0*d%0*d' % (whole_size, whole, fraction_size, fraction)
+  elif isinstance(value, (int, long)):
+    if value < 0:
+      raise ValueError('(EE) %s does not fit in %s' % (value, property))
+    data = '%0*d' % (size, value)
+  else:
+    data = str(value)
+    data = data + '\x00' * (size - len(data))
+  if len(data) > size or (kind != 'text' and len(data) != size):
+    raise ValueError('(EE) %s does not fit in %s' % (value, property))
+  return address + offset, data
+
+def decode_sled(buffer, base=0):
+  '''Decode sled metadata from `buffer` holding the EEPROM from `base`
+
+  `buffer` can be anything supporting the buffer interface, e.g. the string
+  returned by `Usb2i2cio.read_EEPROM_bulk(SLED_START, ...)` with `base` as
+  SLED_START, or a memory mapped full EEPROM image with `base` as 0.
+  Laser properties are prefixed by the laser number, e.g. 'L2_FAMILY'.
+  '''
+  sled = SLED.decode(buffer, SLED.origin - base)
+  lasers = sled['LASERS_BCD']
+  if lasers > MAX_LASERS:
+    print '(WW) Sled reports', lasers, 'lasers, decoding', MAX_LASERS
+    lasers = MAX_LASERS
+  for i in range(lasers):
+    sled.update(LASER.decode(buffer,
+                             LASER.origin + LASER_OFFSET * i - base,
+                             'L' + str(i + 1) + '_'))
+  if len(buffer) >= BOARD.origin - base + BOARD.size:
+    sled.update(BOARD.decode(buffer, BOARD.origin - base))
+  return sled
+
+def read_image(path):
+  '''Decode a saved EEPROM image by memory mapping it'''
+  f = open(path, 'rb')
+  try:
+    image = mmap(f.fileno(), 0, access=ACCESS_READ)
+  finally:
+    f.close()
+  try:
+    return decode_sled(image)
+  finally:
+    image.close()
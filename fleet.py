@@ -0,0 +1,277 @@
+'''
+Start and watch every laser launch connected to the host
+
+Each launch is a combiner: a DeVaSys board holding the sled EEPROM, and the
+Prolific squid the lasers of the sled are plugged into.  All boards are
+opened and their sleds read at the same time as the COM ports are
+discovered.  Each squid is then paired with the board whose sled lists the
+lasers answering on its ports, since neither driver tells which USB branch
+a device hangs off.  Pairs known up front, by board serial number, skip the
+probing.
+
+The lasers of all combiners are started and their sleds read on one shared
+pool of worker threads, so another launch adds little to the start up time
+of the host, and one HealthMonitor thread watches every laser afterwards.
+
+Example:
+>>> fleet = Fleet()
+>>> fleet.start()
+>>> fleet.ready()
+True
+>>> fleet.monitor(alarm)
+'''
+
+from Queue import Queue
+from threading import Thread
+
+from devasys import Microcontroller, IoMonitor, EEPROM_CACHE, BOARD_SERIAL, \
+                    count_boards, load_library
+from prolific import ProlificPorts
+from laser import open_serial, run_timed, report
+from session import SessionManager, IDENTITY_CACHE
+from monitor import HealthMonitor
+
+class Pool:
+  '''Fixed set of worker threads shared by every combiner'''
+  def __init__(self, workers=16):
+    self.tasks = Queue()
+    for i in range(workers):
+      thread = Thread(target=self.work)
+      thread.setDaemon(True)
+      thread.start()
+
+  def work(self):
+    while True:
+      function, args, results, index, done = self.tasks.get()
+      try:
+        results[index] = function(*args)
+      except (Exception, SystemExit), error:
+        print '(EE)', getattr(function, '__name__', function), 'failed:', \
+              error
+      done.put(index)
+
+  def call(self, calls):
+    '''Run the list of (function, args) and wait for all of them.  Returns
+    the list of their results, None where the function failed.'''
+    results = [None] * len(calls)
+    done = Queue()
+    for index in range(len(calls)):
+      function, args = calls[index]
+      self.tasks.put((function, args, results, index, done))
+    for index in range(len(calls)):
+      done.get()
+    return results
+
+class Combiner:
+  '''DeVaSys board, sled and squid of a laser launch'''
+  def __init__(self, micro):
+    self.micro = micro
+    self.instance = micro.instance
+    self.sled = micro.eeprom
+    self.board = micro.read_EEPROM(*BOARD_SERIAL)
+    self.squid = None
+    self.ports = []
+    self.mapping = {} # port: identity, see SessionManager.probe
+    self.results = {} # port: result of run_timed()
+    self.io = None    # IoMonitor of the interlock and shutter
+    self.errors = {}  # step: exception, for a launch which is not ready
+
+  def lasers(self, sessions):
+    return [sessions.laser(port) for port in sorted(self.mapping)]
+
+  def fail(self, step, message):
+    print '(EE) Board', self.board + ':', message
+    self.errors[step] = RuntimeError(message)
+
+  def set_leds(self):
+    '''Light the LEDs of the lasers which reached power lock'''
+    locked = [self.mapping[port]['laser'] for port in self.mapping
+              if self.results.get(port, {}).get('state') == 's3']
+    self.micro.set_active_leds(*locked)
+    self.micro.leds.flush()
+
+class Fleet:
+  '''Every laser launch of the host'''
+  def __init__(self, lib=None, registry=None, cache_file=EEPROM_CACHE,
+               port_cache=None, identity_file=IDENTITY_CACHE,
+               opener=open_serial, pairs=None, workers=16):
+    '''
+    Keyword Arguments:
+    lib, cache_file -- as for Microcontroller
+    registry, port_cache -- as for ProlificPorts
+    identity_file, opener -- as for SessionManager
+    pairs -- dictionary of board serial number: squid of known combiners
+    workers -- threads of the pool shared by all combiners, enough to run
+      the state machines of all lasers at once
+    '''
+    if lib is None:
+      lib = load_library()
+    self.lib = lib
+    self.registry = registry
+    self.cache_file = cache_file
+    self.port_cache = port_cache
+    self.sessions = SessionManager(identity_file, opener)
+    self.pairs = pairs or {}
+    self.pool = Pool(workers)
+    self.combiners = []
+    self.ports = None
+    self.health = None
+    self.errors = {}  # board instance: exception, for boards not opened
+
+  def open_board(self, instance):
+    micro = Microcontroller(self.cache_file, self.lib, instance=instance)
+    return Combiner(micro)
+
+  def find_ports(self):
+    return ProlificPorts(self.registry, self.port_cache)
+
+  def open(self):
+    '''Open every board, read its sled and find the squids at once'''
+    boards = count_boards(self.lib)
+    calls = [(self.open_board, (instance,)) for instance in range(boards)]
+    results = self.pool.call(calls + [(self.find_ports, ())])
+    self.ports = results.pop()
+    self.combiners = [combiner for combiner in results
+                      if combiner is not None]
+    self.errors = {}
+    for instance in range(boards):
+      if results[instance] is None:
+        self.errors[instance] = RuntimeError('Board %d not opened' % instance)
+    print '(II) Found', len(self.combiners), 'of', boards, 'DeVaSys boards'
+
+  def pair(self):
+    '''Match each board to the squid holding the lasers of its sled'''
+    squids = list(self.ports.squids)
+    unpaired = []
+    for combiner in self.combiners:
+      squid = self.pairs.get(combiner.board)
+      if squid in squids:
+        combiner.squid = squid
+        squids.remove(squid)
+      else:
+        unpaired.append(combiner)
+    paired = [combiner for combiner in self.combiners
+              if combiner not in unpaired]
+
+    def probe(squid, combiners):
+      # Boards are probed one after another, since they share the ports.
+      # Most trials pair a sled with the wrong squid, so their warnings
+      # are left out and only the pairing chosen is checked below.
+      ports = self.ports.squid_ports[squid]
+      return [self.sessions.probe(ports, combiner.sled, quiet=True)
+              for combiner in combiners]
+
+    calls = [(probe, (combiner.squid, [combiner])) for combiner in paired] + \
+            [(probe, (squid, unpaired)) for squid in squids]
+    results = self.pool.call(calls)
+    for combiner in paired:
+      combiner.mapping = (results.pop(0) or [{}])[0]
+    # Pair the most lasers found first.  A board matching two squids, or a
+    # squid matching two boards, equally well, e.g. launches with the same
+    # sled, cannot be told apart and is left for `pairs` to settle.
+    scores = [] # (lasers found, -board index, squid, mapping)
+    for squid in squids:
+      mappings = results.pop(0) or [{}] * len(unpaired)
+      for i in range(len(unpaired)):
+        scores.append((len(mappings[i]), -i, squid, mappings[i]))
+    scores.sort()
+    while scores:
+      found, order, squid, mapping = scores.pop()
+      ties = [score for score in scores if score[0] == found and
+              (score[1] == order or score[2] == squid)]
+      if ties:
+        orders = [order] + [score[1] for score in ties]
+        tied = [squid] + [score[2] for score in ties]
+        boards = [unpaired[-i].board for i in orders]
+        print '(WW) Boards', ', '.join(sorted(set(boards))), 'match squids', \
+              ', '.join(sorted(set(tied))), 'equally well, give their', \
+              'pairs to tell them apart'
+        scores = [score for score in scores
+                  if score[1] not in orders and score[2] not in tied]
+        continue
+      combiner = unpaired[-order]
+      combiner.squid = squid
+      combiner.mapping = mapping
+      scores = [score for score in scores
+                if score[1] != order and score[2] != squid]
+
+    for combiner in self.combiners:
+      if combiner.squid is None:
+        combiner.fail('pair', 'No squid found')
+        continue
+      combiner.ports = self.ports.squid_ports[combiner.squid]
+      lasers = [identity['laser'] for identity in combiner.mapping.values()]
+      missing = [str(i) for i in range(1, combiner.sled['LASERS_BCD'] + 1)
+                 if i not in lasers]
+      if missing:
+        combiner.fail('identify', 'No port found for laser ' +
+                                  ', '.join(missing))
+      for port, identity in combiner.mapping.items():
+        # Another sled may have been probed on this port last.  Ports
+        # assigned in port order for want of a wavelength are not cached.
+        if self.sessions.identity(port) is not None:
+          self.sessions.identify(port, identity['family'],
+                                 identity['wavelength'], identity['serial'])
+      print '(II) Board', combiner.board, 'uses squid', combiner.squid, \
+            'with', len(combiner.mapping), 'lasers'
+
+  def start(self):
+    '''Bring up every launch.  Returns list of combiners, each with the
+    `errors` keeping it from being ready, see ready().'''
+    self.open()
+    self.pair()
+    self.pool.call([(combiner.micro.bypass, ())
+                    for combiner in self.combiners])
+    lasers = []
+    owners = []
+    for combiner in self.combiners:
+      for laser in combiner.lasers(self.sessions):
+        lasers.append(laser)
+        owners.append(combiner)
+    results = self.pool.call([(run_timed, (laser,)) for laser in lasers])
+    for laser, combiner, result in zip(lasers, owners, results):
+      combiner.results[laser.port] = result or {'state': None, 'error': None}
+    for combiner in self.combiners:
+      report(combiner.lasers(self.sessions), combiner.results)
+      failed = [port for port in sorted(combiner.results)
+                if combiner.results[port]['state'] != 's3' or
+                   combiner.results[port]['error'] is not None]
+      if failed:
+        combiner.fail('start_lasers', 'No power lock on ' + ', '.join(failed))
+      combiner.set_leds()
+    return self.combiners
+
+  def ready(self):
+    '''True if every board was opened and paired, and all lasers of its
+    sled reached power lock'''
+    if self.errors:
+      return False
+    for combiner in self.combiners:
+      if combiner.errors:
+        return False
+    return True
+
+  def monitor(self, callback=None, io_callback=None, interval=2.0):
+    '''Watch the health of every laser from one thread, and the inputs of
+    each board.  `io_callback` is called as io_callback(combiner, name,
+    level, when) on interlock and shutter edges.'''
+    self.health = HealthMonitor(callback)
+    for combiner in self.combiners:
+      for port in combiner.mapping:
+        state = combiner.results.get(port, {}).get('state') or 's0'
+        self.health.add(self.sessions.laser(port), interval, state=state)
+      if io_callback is not None:
+        def edge(name, level, when, combiner=combiner):
+          io_callback(combiner, name, level, when)
+        combiner.io = IoMonitor(combiner.micro, edge)
+        combiner.io.start()
+    self.health.start()
+
+  def close(self):
+    if self.health is not None:
+      self.health.stop()
+    for combiner in self.combiners:
+      if combiner.io is not None:
+        combiner.io.stop()
+      combiner.micro.leds.close()
+    self.sessions.close()
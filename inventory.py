@@ -0,0 +1,267 @@
+'''
+Decode, validate and compare many saved EEPROM images at once
+
+Every image of a directory is memory mapped into one NumPy structured array
+laid out like the EEPROM: the sled header, MAX_LASERS laser records every
+LASER_OFFSET bytes and the board serial number.  Fields are then decoded,
+checked and compared a column at a time for all images together.
+
+Requires NumPy, which the rest of pyALC does not.
+
+Example:
+>>> images = EepromImages('dumps')
+>>> for name, problem in images.problems():
+...   print name, problem
+>>> images.print_table()
+
+or from the command line:
+    python inventory.py dumps --csv lasers.csv
+'''
+
+from os import listdir
+from os.path import join, isdir, getsize, basename
+from re import compile
+from optparse import OptionParser
+
+import numpy
+
+from eeprom import SLED_LAYOUT, LASER_LAYOUT, BOARD_LAYOUT, SLED_START, \
+                   LASER_START, LASER_OFFSET, MAX_LASERS, \
+                   BOARD_SERIAL_ADDRESS, EEPROM_SIZE
+
+MANUFACTURER = 'Andor Technology'
+EEPROM_VERSIONS = ('1',)
+FORMAT = compile(r'(\d*)([sB])') # struct formats used by the layouts
+
+def field_dtype(format):
+  '''NumPy type of a struct format of the layouts, e.g. '16s', or '3s3s'
+  which becomes a record of the fields f0 and f1'''
+  parts = []
+  for count, code in FORMAT.findall(format):
+    if code == 's':
+      parts.append('S' + (count or '1'))
+    else:
+      parts.extend(['u1'] * int(count or 1))
+  if len(parts) == 1:
+    return numpy.dtype(parts[0])
+  return numpy.dtype(','.join(parts))
+
+def layout_dtype(fields, origin, itemsize=None):
+  '''Structured type of `fields` with addresses relative to `origin`'''
+  dtype = {'names': [], 'formats': [], 'offsets': []}
+  for property, address, format, kind in fields:
+    dtype['names'].append(property)
+    dtype['formats'].append(field_dtype(format))
+    dtype['offsets'].append(address - origin)
+  if itemsize is not None:
+    dtype['itemsize'] = itemsize
+  return numpy.dtype(dtype)
+
+LASER = layout_dtype(LASER_LAYOUT, LASER_START, LASER_OFFSET)
+IMAGE = numpy.dtype({
+  'names': ['SLED', 'LASERS', 'BOARD'],
+  'formats': [layout_dtype(SLED_LAYOUT, SLED_START),
+              (LASER, MAX_LASERS),
+              layout_dtype(BOARD_LAYOUT, BOARD_SERIAL_ADDRESS)],
+  'offsets': [SLED_START, LASER_START, BOARD_SERIAL_ADDRESS],
+  'itemsize': EEPROM_SIZE,
+})
+KINDS = dict([(property, kind) for property, address, format, kind in
+              SLED_LAYOUT + LASER_LAYOUT + BOARD_LAYOUT])
+
+def text(column):
+  '''ASCII fields clipped at their first NUL or unwritten 0xFF byte, like
+  eeprom.text() but left as strings'''
+  width = column.dtype.itemsize
+  raw = numpy.ascontiguousarray(column).view(numpy.uint8)
+  raw = raw.reshape(column.shape + (width,))
+  clipped = numpy.cumsum((raw == 0) | (raw == 0xFF), axis=-1) > 0
+  raw = numpy.where(clipped, 0, raw).astype(numpy.uint8)
+  return raw.view('S%d' % width).reshape(column.shape)
+
+def number(column):
+  '''ASCII digit fields as integers, -1 where not a number'''
+  column = text(column)
+  digits = numpy.char.isdigit(column)
+  numbers = numpy.full(column.shape, -1, int)
+  numbers[digits] = column[digits].astype(int)
+  return numbers
+
+def decimal(column):
+  '''Records of ASCII digits either side of the decimal point as floats,
+  NaN where never written'''
+  whole, fraction = column['f0'], column['f1']
+  valid = numpy.char.isdigit(whole) & numpy.char.isdigit(fraction)
+  numbers = numpy.full(column.shape, numpy.nan)
+  numbers[valid] = numpy.char.add(numpy.char.add(whole[valid], '.'),
+                                  fraction[valid]).astype(float)
+  return numbers
+
+def decode(column, property):
+  kind = KINDS[property]
+  if kind == 'decimal':
+    return decimal(column)
+  if kind == 'bcd':
+    return column.astype(int)
+  return text(column)
+
+class EepromImages:
+  '''EEPROM images of many combiners in one structured array'''
+  def __init__(self, paths):
+    '''`paths` is an image file, a directory of images, or a list of
+    either.  Files which are not a whole EEPROM image are skipped.'''
+    if isinstance(paths, basestring):
+      paths = [paths]
+    files = []
+    for path in paths:
+      if isdir(path):
+        files.extend([join(path, name) for name in sorted(listdir(path))])
+      else:
+        files.append(path)
+    self.paths = []
+    for path in files:
+      if getsize(path) == EEPROM_SIZE:
+        self.paths.append(path)
+      else:
+        print '(WW) Skipping', path, 'which is not a', EEPROM_SIZE, \
+              'byte EEPROM image'
+    self.names = numpy.array([basename(path) for path in self.paths])
+    self.data = numpy.empty(len(self.paths), IMAGE)
+    raw = self.data.view(numpy.uint8).reshape(len(self.paths), EEPROM_SIZE)
+    for i in range(len(self.paths)):
+      raw[i] = numpy.memmap(self.paths[i], numpy.uint8, 'r',
+                            shape=(EEPROM_SIZE,))
+    self.count = numpy.minimum(self.data['SLED']['LASERS_BCD'], MAX_LASERS)
+
+  def __len__(self):
+    return len(self.paths)
+
+  def sled(self, property):
+    '''Decoded sled header field of every image'''
+    return decode(self.data['SLED'][property], property)
+
+  def board(self):
+    '''Board serial number of every image'''
+    return text(self.data['BOARD']['BOARD_SERIAL'])
+
+  def lasers(self, property):
+    '''Decoded laser field of every image, one column per laser record'''
+    return decode(self.data['LASERS'][property], property)
+
+  def installed(self):
+    '''True for the laser records each sled says are installed'''
+    return numpy.arange(MAX_LASERS) < self.count[:, numpy.newaxis]
+
+  def validate(self):
+    '''Dictionary of check: True for every image passing it'''
+    lasers = self.data['SLED']['LASERS_BCD']
+    installed = self.installed()
+    return {
+      'manufacturer': self.sled('MANUFACTURER') == MANUFACTURER,
+      'version': numpy.in1d(self.sled('EEPROM_VERSION'), EEPROM_VERSIONS),
+      'lasers': (lasers >= 1) & (lasers <= MAX_LASERS),
+      'families': ~((self.lasers('FAMILY') == '') & installed).any(axis=1),
+      'wavelengths': ~((number(self.data['LASERS']['WAVELENGTH']) < 0) &
+                       installed).any(axis=1),
+    }
+
+  def problems(self):
+    '''List of (image name, check failed)'''
+    failed = []
+    checks = self.validate()
+    for check in sorted(checks):
+      for name in self.names[~checks[check]]:
+        failed.append((name, check))
+    return failed
+
+  def diff(self, reference=None):
+    '''Dictionary of field: names of images differing from their reference
+
+    By default each image is compared to the first image of the same board,
+    showing what changed between dumps of a combiner.  Otherwise all images
+    are compared to the image named `reference`.
+    '''
+    if reference is None:
+      boards = self.board()
+      unique, first, inverse = numpy.unique(boards, return_index=True,
+                                            return_inverse=True)
+      references = first[inverse]
+    else:
+      references = numpy.zeros(len(self), int) + \
+                   list(self.names).index(reference)
+    changes = {}
+    for part in ('SLED', 'BOARD'):
+      for property in self.data[part].dtype.names:
+        column = self.data[part][property]
+        changed = column != column[references]
+        if changed.any():
+          changes[property] = self.names[changed]
+    for property in LASER.names:
+      column = self.data['LASERS'][property]
+      changed = (column != column[references]).any(axis=1)
+      if changed.any():
+        changes['L_' + property] = self.names[changed]
+    return changes
+
+  def table(self):
+    '''Structured array of every installed laser of every image passing
+    all checks of validate()'''
+    valid = numpy.ones(len(self), bool)
+    for passed in self.validate().values():
+      valid &= passed
+    image, laser = numpy.nonzero(self.installed() & valid[:, numpy.newaxis])
+    table = numpy.empty(len(image), [
+      ('IMAGE', self.names.dtype), ('BOARD', 'S16'), ('SERIAL', 'S10'),
+      ('LASER', int), ('FAMILY', 'S16'), ('MODEL', 'S16'),
+      ('WAVELENGTH', int), ('POWER', int), ('AOTF_MHZ', float),
+      ('AOTF_DB', float),
+    ])
+    table['IMAGE'] = self.names[image]
+    table['BOARD'] = self.board()[image]
+    table['SERIAL'] = self.sled('SERIAL')[image]
+    table['LASER'] = laser + 1
+    for property in ('FAMILY', 'MODEL', 'AOTF_MHZ', 'AOTF_DB'):
+      table[property] = self.lasers(property)[image, laser]
+    for property in ('WAVELENGTH', 'POWER'):
+      table[property] = number(self.data['LASERS'][property])[image, laser]
+    return table
+
+  def write_csv(self, f, table=None):
+    if table is None:
+      table = self.table()
+    f.write(','.join(table.dtype.names) + '\n')
+    for row in table:
+      f.write(','.join([str(value) for value in row]) + '\n')
+
+  def print_table(self, table=None):
+    if table is None:
+      table = self.table()
+    widths = [max([len(name)] + [len(str(value)) for value in table[name]])
+              for name in table.dtype.names]
+    print ' '.join([name.rjust(width) for name, width in
+                    zip(table.dtype.names, widths)])
+    for row in table:
+      print ' '.join([str(value).rjust(width) for value, width in
+                      zip(row, widths)])
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='%prog [options] directory|image ...')
+  parser.add_option('--csv', help='write the laser table to this file')
+  parser.add_option('--reference',
+                    help='image to compare all others against, instead of '
+                         'the first image of each board')
+  options, paths = parser.parse_args()
+  if not paths:
+    parser.error('no images given')
+  images = EepromImages(paths)
+  print '(II) Read', len(images), 'images'
+  for name, check in images.problems():
+    print '(WW)', name, 'failed check:', check
+  for property, names in sorted(images.diff(options.reference).items()):
+    print '(II)', property, 'differs in:', ' '.join(names)
+  if options.csv is not None:
+    f = open(options.csv, 'w')
+    images.write_csv(f)
+    f.close()
+  else:
+    images.print_table()
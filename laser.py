@@ -10,40 +10,129 @@ Cobolt: Compass, Calypso
 Melles Griot: 560
 '''
 
-from serial import Serial
-from time import sleep
+from time import time, sleep
 from string import rjust
+from threading import Thread, RLock
+from metrics import METRICS
+from protocol import Protocol, Bits, TransitionTable, matcher, SAPPHIRE, \
+                     CUBE, COBOLT3, COBOLT4
+
+class PollScheduler:
+  '''Delays between status polls adapted to the laser state
+  
+  Polls are fast right after a command, when the laser is expected to change
+  state.  While warming up (s2) the delay grows by `backoff` each poll up to
+  `slow`, since lock takes minutes and a few seconds of latency is harmless.
+  '''
+  def __init__(self, fast, slow, backoff=1.5):
+    self.fast = fast
+    self.slow = slow
+    self.backoff = backoff
+    self.delay = fast
+  
+  def reset(self):
+    '''Poll fast again, e.g. after sending a command'''
+    self.delay = self.fast
+  
+  def next(self, state):
+    '''Seconds to wait before the next status poll in `state`'''
+    if state != 's2':
+      return self.fast
+    delay = self.delay
+    self.delay = min(self.delay * self.backoff, self.slow)
+    return delay
+
+
+def open_serial(port, baudrate=19200, timeout=1):
+  '''Open COM port with the settings shared by the lasers'''
+  from serial import Serial
+  ser = \
+  Serial(
+    port = port,
+    baudrate = baudrate,
+    bytesize = 8,
+    parity='N', stopbits=1, timeout=timeout
+  )
+  try:
+    ser.setRTS(level=1)
+    ser.setDTR(level=1)
+  except:
+    ser.close() # since an exception leaves the COM port open
+    raise
+  return ser
+
+
+def nanometres(value):
+  '''Wavelength `value` of a reply or sled field as whole nm, or None'''
+  try:
+    return int(round(float(value)))
+  except (TypeError, ValueError):
+    return None
+
 
 class Laser:
-  '''Serial laser device communication'''
-  def __init__(self, port):
-    '''Set serial communication defaults and open COM port'''
+  '''Serial laser device communication
+  
+  Subclasses set PROTOCOL to the compiled spec of their family, see
+  protocol.py, from which the commands, expected replies, fault names and
+  state transitions are taken.
+  '''
+  PROTOCOL = None
+  
+  def __init__(self, port, ser=None):
+    '''Set serial communication defaults and open COM port
+    
+    An already opened serial link with the pySerial interface can be passed
+    as `ser`, e.g. a simulator.SimulatedSapphire.
+    '''
     self.port = port
     self.BAUD = 19200
     self.COMMAND_DELAY = 0.5    # seconds
     self.TIMEOUT_STABILIZE = 3  # minutes
+    self.WAVELENGTH = None      # query of the wavelength, if any
+    if self.PROTOCOL is not None:
+      self.configure(self.PROTOCOL)
+    self.POLL_INTERVAL = (0.05, 2.0) # seconds after a command, while warming
     self.JUNK_CHARACTERS = '\r\n\x00'
+    self.lock = RLock() # serializes commands from several threads
+    self.pushback = None # line read ahead of a pipelined reply
+    self.PIPELINE = True # write multiple command sequences at once
+    self.verbose = False # print every command, reply and state
+    self.time = time     # clock of run(), virtual when replaying a log
+    self.sleep = sleep
     
-    try:
-      self.ser = \
-      Serial(
-        port = port,
-        baudrate = self.BAUD,
-        bytesize = 8,
-        parity='N', stopbits=1, timeout=1
-      )
-      self.ser.setRTS(level=1)
-      self.ser.setDTR(level=1)
-      if self.ser.isOpen():
-        print '(II) Successfully opened serial port', self.port
-      else:
-        print '(EE) Failed to open serial port', self.port
-        return
-    except:
-      self.ser.close() # since an exception leaves the COM port open
-      raise
+    if ser is not None:
+      self.ser = ser
+      return
+    
+    self.ser = open_serial(port, self.BAUD)
+    if self.ser.isOpen():
+      print '(II) Successfully opened serial port', self.port
+    else:
+      print '(EE) Failed to open serial port', self.port
   
-  def serial_check(self, command_list, expected_output_list=None):
+  def configure(self, protocol):
+    '''Take the commands and tables of the compiled `protocol`'''
+    commands = protocol.commands
+    self.INIT = commands['INIT']
+    self.ON = commands['ON']
+    self.OFF = commands['OFF']
+    self.CHECK_STATUS = commands['CHECK_STATUS']
+    self.CHECK_ERROR = commands['CHECK_ERROR']
+    self.IDENTIFY = protocol.identify
+    self.IDENTITY = protocol.identity
+    self.SERIAL = protocol.serial
+    self.WAVELENGTH = protocol.wavelength
+    # Expected output of INIT and CHECK_STATUS
+    self.INIT_OUTPUT = protocol.expect(self.INIT)
+    self.STATUS_OUTPUT = protocol.expect(self.CHECK_STATUS)
+    self.STATUS = protocol.status
+    self.ERROR = protocol.errors
+    self.TRANSITION_MATRIX = protocol.transitions
+    self.TIMEOUT_STABILIZE = protocol.timeout
+  
+  def serial_check(self, command_list, expected_output_list=None,
+                   pipeline=False):
     '''Process multiple serial commands compare against expected output.
     
     Arguments:
@@ -55,13 +144,18 @@ class Laser:
     expected_output_list --
       list or tuple of response from serial device
       e.g. [None, 'OK']
+    pipeline --
+      write all commands back to back before reading any reply, so the
+      sequence costs about one round trip instead of one per command.
+      Replies are matched to commands by their echo, if the laser has one,
+      otherwise by order.
     
     A single command will still go through if no expected output is provided.
     This is to account for 'dumb' devices which do not respond, and for testing
     purposes, but otherwise it's bad practise so a warning is printed.  If one
     expects no output for a command, use `None`.
     '''
-    verbose=True
+    verbose = self.verbose
     output_list = []
     
     if not (isinstance(command_list,tuple) or isinstance(command_list,list)):
@@ -72,13 +166,16 @@ class Laser:
       # Add `None` till the length matches
       expected_output_list.append(None)
     
+    if pipeline:
+      outputs = self.transact_pipelined(command_list)
+    
     for i in range(0,len(command_list)):
       command = command_list[i]
       expected_output = expected_output_list[i]
-      #print 'DEBUG: About to write serial command'
-      self.ser.write(command + '\r\n')
-      sleep(0.01) # wait 10ms
-      output = self.ser.readlines() # takes seconds to read all lines
+      if pipeline:
+        output = outputs[i]
+      else:
+        output = self.transact(command)
       
       if verbose:
         print rjust(command,20), ':', output,
@@ -102,44 +199,179 @@ class Laser:
         output_list.append(output)
        
       output_found = 0
+      match = matcher(expected_output)
       
       for string in output:
-        # first assume number of expected outputs to check is just 1
-        i = 1
-        expected_output_item = expected_output
-        
-        # if multiple outputs are possible for this command,
-        #   increase the expected_output list iteration
-        if isinstance(expected_output,list) or\
-           isinstance(expected_output,tuple):
-          i = len(expected_output)
-          expected_output_item = str(expected_output[0])
-        
-        while i > 0 and not output_found:
-          stripped_output = string.strip(self.JUNK_CHARACTERS)
-          if stripped_output == expected_output_item:
-            output_found = 1
-            output_list.append(stripped_output)
+        stripped_output = string.strip(self.JUNK_CHARACTERS)
+        if match(stripped_output):
+          output_found = 1
+          output_list.append(stripped_output)
+          if verbose:
             print '-OK'
-            i = 1
-          i -= 1
-          if i > 0:
-            expected_output_item = str(expected_output[i])
+          break
       
       if not output_found:
         # FIXME: Return value of `False` is difficult handle.
         #   This would be better if there was a `tries` variable for the
         #   serial_check function to attempt to get the value it wants.
         #   default could be 3?
-        print '-Expected output not found'
-        print '(WW) serial_check(): Expected', expected_output_item,\
+        if verbose:
+          print '-Expected output not found'
+        print '(WW) serial_check(): Expected', expected_output,\
               'but got', output
         output_list.append(False)
     
     return output_list
   
+  def transact(self, command):
+    '''Write `command` and return the raw lines of its reply'''
+    self.lock.acquire()
+    try:
+      self.ser.flushInput()
+      self.pushback = None
+      if not METRICS.enabled:
+        self.ser.write(self.encode(command))
+        return self.read_reply(command)
+      start = time()
+      self.ser.write(self.encode(command))
+      output = self.read_reply(command)
+      METRICS.observe('laser_command_seconds', time() - start,
+                      port=self.port, command=command)
+      return output
+    finally:
+      self.lock.release()
+  
+  def transact_pipelined(self, command_list):
+    '''Write all of `command_list` at once and return the raw lines of each
+    reply'''
+    self.lock.acquire()
+    try:
+      self.ser.flushInput()
+      self.pushback = None
+      timed = METRICS.enabled # read once, it may be switched on meanwhile
+      if timed:
+        start = time()
+      self.ser.write(''.join([self.encode(command)
+                              for command in command_list]))
+      outputs = []
+      for i in range(len(command_list)):
+        next_command = None
+        if i + 1 < len(command_list):
+          next_command = command_list[i + 1]
+        outputs.append(self.read_reply(command_list[i], next_command))
+      if timed:
+        METRICS.observe('laser_pipeline_seconds', time() - start,
+                        port=self.port, commands=len(command_list))
+      return outputs
+    finally:
+      self.lock.release()
+  
+  def query(self, command):
+    '''Write `command` and return its reply without echo or blank lines
+    e.g. query('?STA') returns ['5']'''
+    output = []
+    echo = self.echo(command)
+    for line in self.transact(command):
+      line = line.strip(self.JUNK_CHARACTERS + '\t ')
+      if line and not (echo is not None and not output and line == echo):
+        output.append(line)
+    return output
+  
+  def identify(self):
+    '''Serial number if the laser answers IDENTIFY like this family, else
+    None'''
+    reply = self.query(self.IDENTIFY)
+    if not (reply and self.IDENTITY.match(reply[0])):
+      return None
+    if self.SERIAL != self.IDENTIFY:
+      reply = self.query(self.SERIAL)
+    if reply:
+      return reply[0]
+    return None
+  
+  def wavelength(self):
+    '''Wavelength in nm the laser reports, or None if it cannot tell'''
+    if self.WAVELENGTH is None:
+      return None
+    reply = self.query(self.WAVELENGTH)
+    return nanometres(reply and reply[0])
+  
+  def encode(self, command):
+    '''Bytes written to send `command`'''
+    if self.PROTOCOL is None:
+      return command + '\r\n'
+    return self.PROTOCOL.encode(command)
+  
+  def echo(self, command):
+    '''Line the laser echoes back before replying to `command`, if any'''
+    if self.PROTOCOL is not None and self.PROTOCOL.echo:
+      return command
+    return None
+  
+  def reply_lines(self, command):
+    '''Number of lines making up the complete reply to `command`'''
+    if self.PROTOCOL is None:
+      return 1
+    return self.PROTOCOL.reply_lines(command)
+  
+  def expect(self, command_list):
+    '''List of the expected reply to each of `command_list`'''
+    if self.PROTOCOL is None:
+      return list(command_list)
+    return self.PROTOCOL.expect(command_list)
+  
+  def decode_error(self, reply):
+    '''Name of the fault reported by the CHECK_ERROR `reply`'''
+    if self.PROTOCOL is None:
+      return self.ERROR.get(reply, reply)
+    return self.PROTOCOL.decode_error(reply)
+  
+  def read_reply(self, command, next_command=None):
+    '''Read the reply to `command`, returning as soon as it is complete.
+    
+    Lines are read one at a time so the serial timeout only comes into play
+    when the laser is silent.  Lines before the echo of `command` are stale
+    output of an earlier command and are dropped.  Lines already waiting
+    after the reply, e.g. a Sapphire fault listing, are kept.
+    
+    When `next_command` was written right after `command`, waiting lines
+    are kept only up to its echo.  Lasers without an echo are trusted to
+    send exactly `reply_lines()` per command.
+    '''
+    output = []
+    echo = self.echo(command)
+    lines = self.reply_lines(command)
+    while len(output) < lines:
+      line = self.pushback or self.ser.readline()
+      self.pushback = None
+      if not line:
+        break # timed out
+      if echo is not None and not output and \
+         line.strip(self.JUNK_CHARACTERS) != echo:
+        continue
+      output.append(line)
+    if next_command is not None:
+      next_echo = self.echo(next_command)
+      if next_echo is None:
+        return output
+    else:
+      next_echo = None
+    while self.ser.inWaiting():
+      line = self.ser.readline()
+      if next_echo is not None and \
+         line.strip(self.JUNK_CHARACTERS) == next_echo:
+        self.pushback = line # first line of the next reply
+        break
+      output.append(line)
+    return output
+  
   def run(self, loop=False):
-    '''Loop the laser state machine until it reaches '''
+    '''Loop the laser state machine until it reaches power lock or an error.
+    
+    Returns the final machine state, e.g. 's3' when the laser is locked.  The
+    visited states are kept in `state_history`, and the seconds spent in
+    each state are counted in METRICS when enabled.
+    '''
     # States
     S = {
       's0': 'Unknown laser state',
@@ -150,20 +382,24 @@ class Laser:
     }
     
     # Initial state
-    self.serial_check(self.INIT, ['>=0', 'L=1'])
+    self.serial_check(self.INIT, list(self.INIT_OUTPUT), self.PIPELINE)
     machine_state = 's0'
     state_history = []
+    self.state_history = state_history
     machine_input = self.serial_check(self.CHECK_STATUS,
-                                      [self.list_to_str(range(1,7))])
+                                      list(self.STATUS_OUTPUT))
     state_history.append(S[machine_state])
     
-    i = 100 # FIXME: timeout
+    poll = PollScheduler(*self.POLL_INTERVAL)
+    state_entered = self.time()
+    last_action = None
     
-    while(i > 0):
-      print machine_state, ':', machine_input
+    while True:
+      if self.verbose:
+        print self.port, machine_state, ':', machine_input
       
       try:
-        machine_state, expected_state, next_command = \
+        next_state, expected_state, next_command = \
           self.TRANSITION_MATRIX[machine_state, tuple(machine_input)]
       except TypeError:
         print 'Variables values:'
@@ -171,6 +407,13 @@ class Laser:
         print 'machine_input', machine_input
         raise
       
+      if next_state != machine_state:
+        now = self.time()
+        if METRICS.enabled:
+          METRICS.count('laser_state_seconds', now - state_entered,
+                        port=self.port, state=machine_state)
+        state_entered = now
+      machine_state = next_state
       state_history.append(S[machine_state])
       try:
         if state_history[-1] == state_history[-2]:
@@ -188,68 +431,48 @@ class Laser:
       if machine_state == 's3':
         print '(II) State machine completed successfully'
         break
-        
-      if next_command is not None:
-        machine_input = self.serial_check(next_command,
-                                          next_command)
-        machine_input = self.serial_check(self.CHECK_STATUS,
-                                          [self.list_to_str(range(1,7))])
-        
-        if machine_input == [False]:
-          # Laser has glitched or does not produce sane output
-          # FIXME: This should be fixed in serial_check
-          machine_input = self.serial_check(self.CHECK_STATUS,
-                                            [self.list_to_str(range(1,7))])
-        #print 'Machine input:', machine_input
       
-      i -= 1
+      if self.time() - state_entered > self.TIMEOUT_STABILIZE * 60:
+        print '(EE) No power lock after', self.TIMEOUT_STABILIZE, \
+              'minutes in state:', S[machine_state]
+        if METRICS.enabled:
+          METRICS.count('laser_state_seconds', self.time() - state_entered,
+                        port=self.port, state=machine_state)
+          state_entered = self.time()
+        machine_state = 's4'
+        state_history.append(S[machine_state])
+        break
+      
+      # Only repeat the action when the laser reports something new
+      action = (machine_state, tuple(machine_input))
+      if next_command is not None and action != last_action:
+        self.serial_check(next_command, self.expect(next_command),
+                          self.PIPELINE)
+        last_action = action
+        poll.reset()
+      
+      self.sleep(poll.next(machine_state))
+      machine_input = self.serial_check(self.CHECK_STATUS,
+                                        list(self.STATUS_OUTPUT))
+      
+      if machine_input == [False]:
+        # Laser has glitched or does not produce sane output
+        # FIXME: This should be fixed in serial_check
+        if METRICS.enabled:
+          METRICS.count('laser_retries_total', port=self.port)
+        machine_input = self.serial_check(self.CHECK_STATUS,
+                                          list(self.STATUS_OUTPUT))
     
+    if METRICS.enabled:
+      METRICS.count('laser_state_seconds', self.time() - state_entered,
+                    port=self.port, state=machine_state)
     print '(II) run() ended'
+    return machine_state
     
   def stop(self):
     # FIXME: Implement this
     pass
     
-  def bin_expand(binary):
-    '''Returns binary permutations from a string of 1, 0 and x (don't care)
-    
-    Example:
-    >>> bin_expand('0x11')
-    [
-      '0b0011',
-      '0b0111',
-    ]
-    '''
-    result = []
-    for n in binary:
-      if n == 'x':
-        if len(result) == 0:
-          result = ['0b1','0b']
-        else:
-          i = 0
-          length = len(result)
-          while i < length:
-            result[i] = result[i] + '0'
-            result.append(result[i] + '1')
-            i += 1
-      else:
-        if len(result) == 0:
-          result = ['0b' + n]
-        else:
-          i = 0
-          while i < len(result):
-            result[i] = result[i] + n
-    return result
-  
-  def transition_expand(self,shorthand):
-    expanded = {}
-    for key, value in shorthand.iteritems():
-      state = key[0]
-      inputs = key[1]
-      for input in inputs:
-        expanded[(state, (input,))] = value
-    return expanded
-  
   def list_to_str(self, number_list):
     list_of_strings = []
     for number in number_list:
@@ -259,90 +482,91 @@ class Laser:
 
 class Sapphire(Laser):
   '''Laser control of Coherent Sapphire'''
-  def __init__(self, port):
-    # Laser commands and definitions
-    self.INIT = ['>=0', 'L=1']
-    self.ON = ['L=1']
-    self.OFF = ['L=0']
-    self.CHECK_STATUS = ['?STA']
-    self.CHECK_ERROR = ['?F']
-    self.ERROR = {
-      '1': 'Interlock',
-    }
-    # State transition table, grouping state inputs in 'shorthand'
-    TRANSITION_SHORTHAND = {
-      ('s0', ('6',)): ('s1', 1, self.INIT),
-      ('s0', self.list_to_str(range(1,5))): ('s2', 1, self.ON),
-      ('s0', ('5',)): ('s3', 1, None),
-      ('s1', self.list_to_str(range(1,5))): ('s2', 1, self.ON),
-      ('s1', ('5',)): ('s3', 1, None),
-      ('s1', ('6',)): ('s4', 0, None),
-      ('s2', ('5',)): ('s3', 1, None),
-      ('s2', self.list_to_str(range(1,5))): ('s2', 1, self.ON),
-      ('s2', ('6',)): ('s2', 0, None),
-      ('s3', ('5',)): ('s3', 1, None),
-      ('s3', ('6',)): ('s3', 0, None),
-      ('s3', self.list_to_str(range(1,5))): ('s3', 0, None),
-    }    
-    self.TRANSITION_MATRIX = self.transition_expand(TRANSITION_SHORTHAND)
-    
-    # Boilerplate for running the laser
-    Laser.__init__(self, port)
+  PROTOCOL = Protocol(SAPPHIRE)
+
+
+class Cube(Laser):
+  '''Laser control of Coherent Cube'''
+  PROTOCOL = Protocol(CUBE)
+
+
+class Cobolt3(Laser):
+  '''Laser control of Cobolt Generation 3'''
+  PROTOCOL = Protocol(COBOLT3)
 
 
 class Cobolt4(Laser):
   '''Laser control of Cobolt Generation 4'''
-  def __init__(self, port):
-    self.INIT = ['cf']
-    self.ON = ['lten1', 'xten1', '@cob 1', 'l1']
-    self.OFF = ['l0']
-    self.CHECK_STATUS = ['leds?']
-    self.CHECK_ERROR = ['f?']
-    self.ERROR = {
-      3: 'Interlock',
-    }
-    
-    Laser.__init__(self, port)
-    
-    # State transition table, grouping state inputs in 'shorthand'
-    ex = self.bin_expand
-    TRANSITION_SHORTHAND = {
-      ('s0', ex('0xxx')): ('s1', 1, self.INIT),
-      ('s0', ex('11xx')): ('s2', 1, None),
-      ('s0', ex('10xx')): ('s3', 1, None),
-      ('s1', ex('11xx')): ('s2', 1, self.ON),
-      ('s1', ex('10xx')): ('s2', 1, None),
-      ('s1', ex('00xx')): ('s4', 0, None),
-      ('s2', ex('10xx')): ('s3', 1, None),
-      ('s2', ex('11xx')): ('s2', 1, None),
-      ('s2', ex('0xxx')): ('s4', 0, None),
-      ('s3', ex('10xx')): ('s3', 1, None),
-      ('s3', ex('11xx')): ('s4', 0, None),
-      ('s3', ex('0xxx')): ('s4', 0, None),
-    }    
-    self.TRANSITION_MATRIX = self.transition_expand(TRANSITION_SHORTHAND)
+  PROTOCOL = Protocol(COBOLT4)
+
+# Laser classes by the family name stored in the sled EEPROM
+FAMILIES = {
+  'SAPPHIRE': Sapphire,
+  'CUBE': Cube,
+  'COBOLTJIVE': Cobolt3,
+  'COBOLTFANDANGO': Cobolt3,
+  'COBOLTMAMBO': Cobolt3,
+  'COBOLTJIVE4': Cobolt4,
+  'COBOLTFANDANGO4': Cobolt4,
+  'COBOLTMAMBO4': Cobolt4,
+}
+
+# Order in which a port is probed for each family.  Families identified by
+# a query of their own go first, since a Sapphire also answers the ?HID of
+# a Cube and a Cobolt generation 3 the sn? of a generation 4.
+PROBE_ORDER = (Cube, Cobolt4, Sapphire, Cobolt3)
+
+def run_timed(laser):
+  '''Run the state machine of `laser`, returning a dictionary of the final
+  `state`, the `history` of states, the `seconds` taken and any `error`
+  raised'''
+  result = {'state': None, 'history': [], 'seconds': 0.0, 'error': None}
+  start = time()
+  try:
+    result['state'] = laser.run()
+  except Exception, error:
+    result['error'] = error
+  result['history'] = getattr(laser, 'state_history', [])
+  result['seconds'] = time() - start
+  return result
+
+def report(lasers, results):
+  '''Print the results of run_timed() of each laser'''
+  for laser in lasers:
+    result = results[laser.port]
+    print '(II)', laser.port, 'finished in', '%.1f' % result['seconds'], \
+          's with state', result['state']
+    if result['error'] is not None:
+      print '(EE)', laser.port, 'raised', repr(result['error'])
+
+def bring_up(lasers):
+  '''Run the state machines of several lasers side by side.
   
-  '''
-  Command strings:
-  - Initialize
-  - Turn on
-  - Turn off
-  - Status condition
-  - Error condition
+  Each laser is started in its own thread, so the total start up time is
+  that of the slowest laser instead of the sum of all warm ups.
   
-  Tertiary commands
-  - Power rating
-  - Regex to confirm identity of laser if unknown
+  Arguments:
+  lasers --
+    list or tuple of opened `Laser` instances
+    e.g. [Sapphire('COM202'), Cobolt4('COM203')]
   
-  Return strings
-  - Status
-    * Power locked
-    * Warming up
-  - Error
-    * Serious fault
-    * Needs recalibration service
+  Returns a dictionary of results of run_timed() keyed by port.
   '''
+  results = {}
+  
+  def worker(laser):
+    results[laser.port] = run_timed(laser)
+  
+  threads = [Thread(target=worker, args=(laser,)) for laser in lasers]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  
+  report(lasers, results)
+  return results
 
 if __name__ == '__main__':
   laser2 = Sapphire('COM202')
+  laser2.verbose = True
   laser2.run()
@@ -2,26 +2,186 @@
 Turn on Andor Laser Launch as a 'dumb' box for Analog control
 
 Andor uses several brands of diode solid-state continuous wave lasers in the
-launch.  Rejects serial squids not on the same USB parent branch as the DeVaSys.
+launch.
+
+The start up is a graph of stages, each run as soon as the stages it needs
+have finished, so independent stages overlap, e.g. the COM ports are
+discovered while the sled EEPROM is read:
+
+  find_ports ------------------+
+  open_board --+-- read_sled --+-- identify --+-- start_lasers -- set_leds
+               +-- bypass --------------------+
+
+Example:
+>>> launch = Launch()
+>>> launch.run()
+>>> launch.report()
 '''
 
-from devasys import Microcontroller
+from threading import Thread, Condition
+from time import time
+
+from devasys import Microcontroller, EEPROM_CACHE
 from prolific import ProlificPorts
-from laser import Cube, Sapphire, Cobolt3, Cobolt4
-
-class Launch():
-  def __init__(self_):
-    TYPE = (
-      'CUBE',
-      'SAPPHIRE',
-    )
-    if type not in TYPE:
-      if type in ['COBOLTJIVE', 'COBOLTFANDANGO', 'COBOLTMAMBO']:
-        type = 'COBOLT3'
-      elif type in ['COBOLTJIVE4', 'COBOLTFANDANGO4', 'COBOLTMAMBO4']:
-        type = 'COBOLT4'
-      else:
-        print 'LaserError: Unknown type of laser:', type
-        return
-    
-    
\ No newline at end of file
+from laser import open_serial, bring_up
+from session import SessionManager, IDENTITY_CACHE
+from metrics import METRICS
+
+class Launch:
+  '''Start up of the laser launch, from opening the board to LEDs lit'''
+  # (stage, stages it needs), each stage being a method of this class
+  STAGES = (
+    ('open_board', ()),
+    ('read_sled', ('open_board',)),
+    ('find_ports', ()),
+    ('bypass', ('open_board',)),
+    ('identify', ('read_sled', 'find_ports')),
+    ('start_lasers', ('identify', 'bypass')),
+    ('set_leds', ('start_lasers',)),
+  )
+
+  def __init__(self, lib=None, registry=None, cache_file=EEPROM_CACHE,
+               port_cache=None, identity_file=IDENTITY_CACHE,
+               opener=open_serial):
+    '''The arguments are handed to Microcontroller, ProlificPorts and
+    SessionManager, e.g. to start up simulated hardware'''
+    self.lib = lib
+    self.registry = registry
+    self.cache_file = cache_file
+    self.port_cache = port_cache
+    self.sessions = SessionManager(identity_file, opener)
+    self.micro = None
+    self.sled = None
+    self.ports = None
+    self.mapping = {} # port: identity of the laser, see SessionManager.probe
+    self.results = {} # port: result of the laser state machine
+    self.timings = {} # stage: (start, end) in seconds since run() started
+    self.errors = {}  # stage: exception raised, or None if skipped
+
+  def open_board(self):
+    self.micro = Microcontroller(self.cache_file, self.lib, read_sled=False)
+
+  def read_sled(self):
+    if self.cache_file is None:
+      self.sled = self.micro.read_sled_EEPROM()
+    else:
+      self.sled = self.micro.read_sled_EEPROM_cached(self.cache_file)
+
+  def find_ports(self):
+    self.ports = ProlificPorts(self.registry, self.port_cache)
+
+  def bypass(self):
+    self.micro.bypass()
+
+  def identify(self):
+    self.mapping = self.sessions.probe(self.ports.COM, self.sled)
+    lasers = [identity['laser'] for identity in self.mapping.values()]
+    missing = [str(i) for i in range(1, self.sled['LASERS_BCD'] + 1)
+               if i not in lasers]
+    if missing:
+      # Recorded rather than raised, so the lasers found are still started
+      print '(EE) No port found for laser', ', '.join(missing)
+      self.errors['identify'] = \
+        RuntimeError('No port found for laser ' + ', '.join(missing))
+
+  def start_lasers(self):
+    lasers = [self.sessions.laser(port) for port in sorted(self.mapping)]
+    self.results = bring_up(lasers)
+    failed = [port for port in sorted(self.results)
+              if self.results[port]['state'] != 's3' or
+                 self.results[port]['error'] is not None]
+    if failed:
+      # Recorded rather than raised, so set_leds still lights the lasers
+      # which did reach power lock
+      print '(EE) No power lock on', ', '.join(failed)
+      self.errors['start_lasers'] = \
+        RuntimeError('No power lock on ' + ', '.join(failed))
+
+  def set_leds(self):
+    locked = [self.mapping[port]['laser'] for port in self.mapping
+              if self.results[port]['state'] == 's3']
+    self.micro.set_active_leds(*locked)
+    self.micro.leds.flush()
+
+  def run(self):
+    '''Run every stage once its dependencies succeeded, stages without
+    dependencies between them at the same time.  A stage whose
+    dependency failed is skipped.
+
+    Returns True if all stages succeeded and every laser reached power
+    lock.
+    '''
+    start = time()
+    condition = Condition()
+    done = {} # stage: True if succeeded
+    started = []
+    self.timings = {}
+    self.errors = {}
+
+    def worker(name):
+      began = time()
+      succeeded = False
+      try:
+        getattr(self, name)()
+        succeeded = True
+      except (Exception, SystemExit), error:
+        print '(EE) Stage', name, 'failed:', error
+        self.errors[name] = error
+      ended = time()
+      if METRICS.enabled:
+        METRICS.observe('launch_stage_seconds', ended - began, stage=name)
+      condition.acquire()
+      self.timings[name] = (began - start, ended - start)
+      done[name] = succeeded
+      condition.notify()
+      condition.release()
+
+    condition.acquire()
+    try:
+      while len(done) < len(self.STAGES):
+        progress = False
+        for name, requires in self.STAGES:
+          if name in done or name in started:
+            continue
+          if [stage for stage in requires if stage not in done]:
+            continue
+          progress = True
+          if [stage for stage in requires if not done[stage]]:
+            print '(WW) Skipping stage', name
+            self.errors[name] = None
+            done[name] = False
+            continue
+          started.append(name)
+          thread = Thread(target=worker, args=(name,))
+          thread.setDaemon(True)
+          thread.start()
+        if not progress:
+          condition.wait()
+    finally:
+      condition.release()
+    self.seconds = time() - start
+    return len(self.errors) == 0
+
+  def report(self):
+    '''Print when each stage ran and for how long'''
+    print '(II) %-13s %8s %8s' % ('Stage', 'Start', 'Seconds')
+    for name in sorted(self.timings, key=self.timings.get):
+      began, ended = self.timings[name]
+      print '(II) %-13s %8.3f %8.3f' % (name, began, ended - began)
+    for name, requires in self.STAGES:
+      if name not in self.timings:
+        print '(II) %-13s %8s %8s' % (name, '-', 'skipped')
+    if self.errors:
+      print '(EE) Not ready, stopped after %.3f seconds' % self.seconds
+    else:
+      print '(II) Ready after %.3f seconds' % self.seconds
+
+  def close(self):
+    if self.micro is not None:
+      self.micro.leds.close()
+    self.sessions.close()
+
+if __name__ == '__main__':
+  launch = Launch()
+  launch.run()
+  launch.report()
@@ -0,0 +1,156 @@
+'''
+Collect timings and counters of the launch start up
+
+Instrumented code calls the shared METRICS registry only after checking
+`METRICS.enabled`, so nothing is timed or counted, and no clock is read,
+unless collection was switched on:
+
+>>> from metrics import METRICS
+>>> METRICS.enabled = True
+>>> ... start the launch ...
+>>> METRICS.write_prometheus('pyalc.prom')  # node_exporter textfile format
+>>> METRICS.write_json('pyalc.json')
+
+Collected:
+  laser_command_seconds     histogram of serial command round trips
+  laser_pipeline_seconds    histogram of pipelined command sequences
+  laser_state_seconds       counter of time spent in each state s0-s4
+  laser_retries_total       counter of status queries repeated on glitches
+  i2c_transactions_total    counter of DeVaSys i2c transactions
+  i2c_bytes_total           counter of i2c bytes read and written
+  eeprom_read_seconds       histogram of EEPROM reads
+  launch_stage_seconds      histogram of the start up stages of Launch
+'''
+
+from threading import Lock
+from json import dump
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, float('inf'))
+
+class Histogram:
+  '''Count of observations falling in each of BUCKETS'''
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    for i in range(len(BUCKETS)):
+      if value <= BUCKETS[i]:
+        self.counts[i] = self.counts[i] + 1
+        break
+    self.count = self.count + 1
+    self.sum = self.sum + value
+
+  def cumulative(self):
+    total = 0
+    counts = []
+    for count in self.counts:
+      total = total + count
+      counts.append(total)
+    return counts
+
+class Metrics:
+  '''Registry of counters and histograms keyed by name and labels'''
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.counters = {}   # (name, labels): value
+    self.histograms = {} # (name, labels): Histogram
+    self.lock = Lock()
+
+  def key(self, name, labels):
+    return name, tuple(sorted(labels.items()))
+
+  def count(self, name, value=1, **labels):
+    '''Add `value` to counter `name`'''
+    key = self.key(name, labels)
+    self.lock.acquire()
+    self.counters[key] = self.counters.get(key, 0) + value
+    self.lock.release()
+
+  def observe(self, name, value, **labels):
+    '''Add observation `value` to histogram `name`'''
+    key = self.key(name, labels)
+    self.lock.acquire()
+    try:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(value)
+    finally:
+      self.lock.release()
+
+  def reset(self):
+    self.lock.acquire()
+    self.counters = {}
+    self.histograms = {}
+    self.lock.release()
+
+  def as_dict(self):
+    '''Counters and histograms as lists of plain dictionaries'''
+    self.lock.acquire()
+    try:
+      counters = []
+      for (name, labels), value in sorted(self.counters.items()):
+        counters.append({'name': name, 'labels': dict(labels),
+                         'value': value})
+      histograms = []
+      for (name, labels), histogram in sorted(self.histograms.items()):
+        histograms.append({
+          'name': name,
+          'labels': dict(labels),
+          'count': histogram.count,
+          'sum': histogram.sum,
+          'buckets': zip([str(bound) for bound in BUCKETS],
+                         histogram.cumulative()),
+        })
+      return {'counters': counters, 'histograms': histograms}
+    finally:
+      self.lock.release()
+
+  def prometheus(self):
+    '''Metrics in the Prometheus text exposition format'''
+    def format_labels(labels, extra=()):
+      pairs = ['%s="%s"' % (name, str(value).replace('"', '\\"'))
+               for name, value in tuple(labels) + tuple(extra)]
+      if not pairs:
+        return ''
+      return '{' + ','.join(pairs) + '}'
+    lines = []
+    typed = []
+    self.lock.acquire()
+    try:
+      for (name, labels), value in sorted(self.counters.items()):
+        if name not in typed:
+          typed.append(name)
+          lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %r' % (name, format_labels(labels), value))
+      for (name, labels), histogram in sorted(self.histograms.items()):
+        if name not in typed:
+          typed.append(name)
+          lines.append('# TYPE %s histogram' % name)
+        for bound, count in zip(BUCKETS, histogram.cumulative()):
+          if bound == float('inf'):
+            bound = '+Inf'
+          lines.append('%s_bucket%s %d' % (
+            name, format_labels(labels, (('le', bound),)), count))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                      histogram.sum))
+        lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                        histogram.count))
+    finally:
+      self.lock.release()
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path):
+    f = open(path, 'w')
+    f.write(self.prometheus())
+    f.close()
+
+  def write_json(self, path):
+    f = open(path, 'w')
+    dump(self.as_dict(), f, indent=2, sort_keys=True)
+    f.close()
+
+METRICS = Metrics()
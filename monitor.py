@@ -0,0 +1,168 @@
+'''
+Watch the health of running lasers
+
+Once `Laser.run()` reaches power lock nothing else talks to the lasers.  The
+HealthMonitor keeps polling the status (CHECK_STATUS) and fault (CHECK_ERROR)
+queries of every laser from one background thread, each at its own interval,
+and calls back when a laser drops out of power lock or reports a new fault.
+
+Windows COM ports cannot be waited on with select(), so instead of an event
+loop over file handles the thread sleeps until the next poll is due in a
+schedule shared by all lasers.  Replies are framed by `Laser.read_reply()`,
+so a poll holds the thread only for the round trip of the laser.
+
+Example:
+>>> def alarm(laser, old_state, new_state, status, error):
+...   print laser.port, old_state, '->', new_state, status, error
+>>> monitor = HealthMonitor(alarm)
+>>> monitor.add(laser2, interval=1)
+>>> monitor.start()
+'''
+
+from heapq import heappush, heappop
+from threading import Thread, Condition
+from time import time
+
+class HealthMonitor:
+  '''Poll lasers for status and faults from a single thread'''
+  def __init__(self, callback=None):
+    '''`callback` is called as callback(laser, old_state, new_state,
+    status, error) whenever the state or fault of a laser changes, and
+    with the first fault reply of each laser.'''
+    self.callback = callback
+    self.lasers = {}   # port: watched laser
+    self.schedule = [] # (due time, port, query, generation)
+    self.generation = 0 # counts add(), to drop the polls of removed lasers
+    self.condition = Condition()
+    self.thread = None
+    self.running = False
+
+  def add(self, laser, interval=2.0, error_interval=10.0, callback=None,
+          state='s3'):
+    '''Watch `laser`, polling status every `interval` and faults every
+    `error_interval` seconds.  `callback` overrides the monitor callback
+    for this laser.  `state` is the state the laser was left in by run().'''
+    self.condition.acquire()
+    try:
+      self.generation += 1
+      self.lasers[laser.port] = {
+        'laser': laser,
+        'interval': interval,
+        'error_interval': error_interval,
+        'callback': callback or self.callback,
+        'state': state,
+        'status': None,
+        'error': None, # not polled yet
+        'generation': self.generation,
+      }
+      now = time()
+      heappush(self.schedule, (now, laser.port, 'status', self.generation))
+      if error_interval is not None:
+        heappush(self.schedule, (now, laser.port, 'error', self.generation))
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def remove(self, laser):
+    '''Stop watching `laser`'''
+    self.condition.acquire()
+    self.lasers.pop(laser.port, None)
+    self.condition.release()
+
+  def state(self, laser):
+    '''Last state seen of `laser`, e.g. 's3', or 's4' on error'''
+    return self.lasers[laser.port]['state']
+
+  def start(self):
+    self.running = True
+    self.thread = Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def stop(self):
+    self.condition.acquire()
+    self.running = False
+    self.condition.notify()
+    self.condition.release()
+    if self.thread is not None:
+      self.thread.join()
+
+  def run(self):
+    '''Poll each laser when it is due, sleeping in between'''
+    self.condition.acquire()
+    try:
+      while self.running:
+        if not self.schedule:
+          self.condition.wait()
+          continue
+        due, port, query, generation = self.schedule[0]
+        delay = due - time()
+        if delay > 0:
+          self.condition.wait(delay)
+          continue
+        heappop(self.schedule)
+        watched = self.lasers.get(port)
+        if watched is None or watched['generation'] != generation:
+          continue # removed, or added again with polls of its own
+        self.condition.release()
+        try:
+          if query == 'status':
+            self.poll_status(watched)
+          else:
+            self.poll_error(watched)
+        finally:
+          self.condition.acquire()
+        if query == 'status':
+          interval = watched['interval']
+        else:
+          interval = watched['error_interval']
+        heappush(self.schedule,
+                 (max(due + interval, time()), port, query, generation))
+    finally:
+      self.condition.release()
+
+  def poll_status(self, watched):
+    laser = watched['laser']
+    status = []
+    try:
+      # One value per status query, e.g. the fault and laser on state of a
+      # Cobolt generation 3
+      for command in laser.CHECK_STATUS:
+        status.extend(laser.query(command)[:1])
+    except Exception, error:
+      print '(EE)', laser.port, 'status query failed:', error
+      status = []
+    status = tuple(status)
+    try:
+      next_state, expected_state, next_command = \
+        laser.TRANSITION_MATRIX['s3', status]
+      if not expected_state:
+        next_state = 's4'
+    except KeyError:
+      next_state = 's0' # no sane reply
+    if len(status) != 1:
+      status = (status or None,)
+    self.update(watched, next_state, status[0], watched['error'])
+
+  def poll_error(self, watched):
+    laser = watched['laser']
+    try:
+      reply = laser.query(laser.CHECK_ERROR[0])
+    except Exception, error:
+      print '(EE)', laser.port, 'fault query failed:', error
+      return
+    error = laser.decode_error(' '.join(reply))
+    self.update(watched, watched['state'], watched['status'], error)
+
+  def update(self, watched, state, status, error):
+    '''Record the latest state, calling back if state or fault changed.
+    The first fault poll always calls back, so a fault already present
+    when the laser was added is reported.'''
+    old_state = watched['state']
+    old_error = watched['error']
+    watched['state'] = state
+    watched['status'] = status
+    watched['error'] = error
+    if state != old_state or (error is not None and error != old_error):
+      if watched['callback'] is not None:
+        watched['callback'](watched['laser'], old_state, state, status, error)
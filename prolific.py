@@ -2,18 +2,43 @@
 Detect COM ports from connected Prolific Devices
 
 Reads COM information from Windows registry.  Tested against Windows 7 64-bit
-and Windows XP 32-bit.
+and Windows XP 32-bit.  On Linux the same information is read from sysfs.
 '''
 
-from _winreg import OpenKey, QueryValueEx, EnumValue, HKEY_LOCAL_MACHINE
-from re import search
+from re import compile
 from sys import exit
+from os import listdir
+from os.path import join, realpath, basename, dirname, exists
+from cPickle import dump, load
+
+SQUID = compile(r'(?<=[\\][0-9]&)\w+') # serial number in device instance
+PORT_INDEX = compile(r'[0-9]$')       # port of squid in device instance
+HUB_PORT = compile(r'[0-9]+$')        # hub port of a sysfs USB device
+ENUM = 'SYSTEM\\CurrentControlSet\\Enum\\'
 
 class ProlificPorts:
   '''Cross-references Windows COM port numbers from Prolific devices'''
-  def __init__(self):
-    ''''''
+  def __init__(self, registry=None, cache_file=None):
+    '''Read COM ports from `registry`, by default the Windows _winreg module
+    
+    Any object with the OpenKey, QueryValueEx and EnumValue functions and
+    HKEY_LOCAL_MACHINE of _winreg can be used, e.g.
+    simulator.SimulatedRegistry.
+    
+    With a `cache_file` the port names are remembered for the device
+    instances found, so the Enum key of each port is only opened when the
+    Prolific devices change.  Cached names are never checked again: after
+    a port is renamed in the Device Manager, delete `cache_file`, or the
+    old COM name is used for that squid port.
+    '''
+    if registry is None:
+      import _winreg as registry
+    self.registry = registry
+    OpenKey = registry.OpenKey
+    HKEY_LOCAL_MACHINE = registry.HKEY_LOCAL_MACHINE
     self.squids = []
+    self.squid_ports = {} # squid: COM ports in order of squid port
+    self.cache_file = cache_file
     SER2PL32 = 'SYSTEM\\CurrentControlSet\\Services\\Ser2pl\\Enum'
     SER2PL64 = 'SYSTEM\\CurrentControlSet\\Services\\Ser2pl64\\Enum'
     
@@ -23,62 +48,157 @@ class ProlificPorts:
       self.prolific_path = OpenKey(HKEY_LOCAL_MACHINE, SER2PL32)
       # Have to try Registry instead of platform.architecture, since the
       # latter returns architecture of Python and not of Prolific's driver
-    except WindowsError:
+    except EnvironmentError: # WindowsError
       try:
         # 64-bit
         self.arch = 64
         self.prolific_path = OpenKey(HKEY_LOCAL_MACHINE, SER2PL64)
-      except WindowsError:
+      except EnvironmentError: # WindowsError
         exit('(EE) No Ser2pl or Ser2pl64 service found to control '+
              'Prolific USB-serial COM ports.  Is the Prolific driver'+
              'installed?')
-    self.ports, type = QueryValueEx(self.prolific_path, 'Count')
+    self.ports, type = registry.QueryValueEx(self.prolific_path, 'Count')
     print '(II) Number of devices using', 'Ser2pl' + str(self.arch),\
           'service:', self.ports
     if self.ports is 0:
       exit('(EE) No Prolific USB-serial COM ports found')
-    self.COM = [0] * self.ports
-    self.get_squids()
     self.enumerate_ports()
   
   def get_squids(self):
     '''Return unique serial numbers in Prolific registry'''
-    squids = self.squids
-    try:
-      i = 0
-      while 1:
-        name, string, type = EnumValue(self.prolific_path, i)
-        if type == 1: # 1 is for 'REG_SZ', 'A null-terminated string'
-          sn = search('(?<=[\][0-9]&)\w+',string)
-          if str(sn.group(0)) not in squids:
-            squids.append(str(sn.group(0)))
-        i += 1
-    except WindowsError:
-      pass
+    return self.squids
   
   def enumerate_ports(self):
-    '''List COM ports of each unique squid'''
-    ENUM = 'SYSTEM\\CurrentControlSet\\Enum\\'
+    '''List COM ports of each unique squid in a single pass of the registry
+    
+    `COM` holds the ports of every squid, in order of squid and squid port.
+    Port names of device instances in the cache are taken as they are.
+    '''
+    instances = []
     try:
       i = 0
       while 1:
-        name, string, type = EnumValue(self.prolific_path, i)
+        name, string, type = self.registry.EnumValue(self.prolific_path, i)
         if type == 1: # 1 is for 'REG_SZ', 'A null-terminated string'
-          sn = search('(?<=[\][0-9]&)\w+',string)
-          offset = 0;
-          
-          # Print COMs for each key
-          try:
-            serint = ENUM + string + '\\Device Parameters'
-            serial_path = OpenKey(HKEY_LOCAL_MACHINE,serint)
-            port, type = QueryValueEx(serial_path, 'PortName')
-            self.COM[int(search('[0-9]$',string).group(0)) + 
-                     offset*4 - 1] = str(port)
-          except WindowsError:
-            pass
+          instances.append(string)
         i += 1
-    except WindowsError:
+    except EnvironmentError: # WindowsError
       pass
+    
+    cache = self.load_cache()
+    names = {}
+    for string in instances:
+      if string in cache:
+        names[string] = cache[string]
+        continue
+      try:
+        serial_path = self.registry.OpenKey(
+          self.registry.HKEY_LOCAL_MACHINE,
+          ENUM + string + '\\Device Parameters')
+        port, type = self.registry.QueryValueEx(serial_path, 'PortName')
+        names[string] = str(port)
+      except EnvironmentError: # WindowsError
+        pass
+    if names != cache:
+      self.save_cache(names)
+    
+    ports = {}
+    for string in instances:
+      sn = SQUID.search(string)
+      if sn is None or string not in names:
+        continue
+      squid = str(sn.group(0))
+      if squid not in ports:
+        self.squids.append(squid)
+        ports[squid] = []
+      ports[squid].append((int(PORT_INDEX.search(string).group(0)),
+                           names[string]))
+    self.COM = []
+    for squid in self.squids:
+      self.squid_ports[squid] = [port for index, port in sorted(ports[squid])]
+      self.COM.extend(self.squid_ports[squid])
+  
+  def load_cache(self):
+    '''Port names cached by device instance'''
+    if self.cache_file is None:
+      return {}
+    try:
+      f = open(self.cache_file, 'rb')
+      try:
+        return load(f)
+      finally:
+        f.close()
+    except IOError:
+      return {}
+    except Exception:
+      print '(WW) Ignoring unreadable port cache:', self.cache_file
+      return {}
+  
+  def save_cache(self, names):
+    if self.cache_file is None:
+      return
+    try:
+      f = open(self.cache_file, 'wb')
+      try:
+        dump(names, f, 2)
+      finally:
+        f.close()
+    except IOError:
+      print '(WW) Could not write port cache:', self.cache_file
+
+class SysfsPorts:
+  '''Prolific USB-serial ports of a Linux host, grouped by squid
+  
+  Same `squids`, `squid_ports` and `COM` as ProlificPorts, read from
+  /sys/bus/usb-serial and /dev/serial/by-id.  A squid is the USB hub the
+  ports hang off, named by the hub serial number if it has one.
+  '''
+  def __init__(self, root='/', driver='pl2303'):
+    '''`root` can point to a copy of the sysfs and dev trees, e.g. for
+    testing.  `driver` is the usb-serial driver of the ports.'''
+    self.root = root
+    self.squids = []
+    self.squid_ports = {}
+    self.by_id = {} # port: persistent /dev/serial/by-id name
+    self.enumerate_ports(driver)
+    self.ports = len(self.COM)
+    print '(II) Number of devices using', driver, 'driver:', self.ports
+  
+  def enumerate_ports(self, driver):
+    devices = join(self.root, 'sys', 'bus', 'usb-serial', 'devices')
+    by_id = join(self.root, 'dev', 'serial', 'by-id')
+    if exists(by_id):
+      for name in listdir(by_id):
+        tty = basename(realpath(join(by_id, name)))
+        self.by_id[join('/dev', tty)] = join('/dev', 'serial', 'by-id', name)
+    ports = {}
+    if exists(devices):
+      for tty in sorted(listdir(devices)):
+        path = realpath(join(devices, tty))
+        if basename(realpath(join(path, 'driver'))) != driver:
+          continue
+        device = dirname(dirname(path)) # e.g. 1-1.2, above interface 1-1.2:1.0
+        hub = dirname(device)
+        squid = basename(hub)
+        try:
+          f = open(join(hub, 'serial'))
+          squid = f.read().strip()
+          f.close()
+        except IOError:
+          pass # hub without serial number
+        # Port after the last '.' or, on a root hub, the '-', e.g. 1-1.2, 1-2
+        index = HUB_PORT.search(basename(device))
+        if index is None:
+          print '(WW) Skipping', tty, 'on unexpected USB device', device
+          continue
+        if squid not in ports:
+          self.squids.append(squid)
+          ports[squid] = []
+        ports[squid].append((int(index.group()), join('/dev', tty)))
+    self.COM = []
+    for squid in self.squids:
+      self.squid_ports[squid] = [port for index, port in sorted(ports[squid])]
+      self.COM.extend(self.squid_ports[squid])
 
 if __name__ == '__main__':
   '''
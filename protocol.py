@@ -0,0 +1,390 @@
+'''
+Serial protocols of the laser families as declarative specifications
+
+Each family is described by a dictionary giving its commands, the grammar of
+its replies, what its status codes mean, how its faults decode and the
+transitions of the start up state machine.  A spec is compiled once by
+`Protocol` into the encoded commands, the number of reply lines of each
+command and the matchers of the expected replies, so the Laser classes only
+look things up while talking to the laser.
+
+Spec keys:
+  commands -- dictionary of INIT, ON, OFF, CHECK_STATUS and CHECK_ERROR
+    command lists
+  identify -- (query, regular expression of a valid reply) telling if a
+    port holds a laser of the family
+  serial -- query of the serial number, if not the identify query
+  wavelength -- query of the wavelength in nm, if the laser has one
+  echo -- True if the laser echoes every command before its reply
+  query -- regular expression of the commands answered with a value
+  lines -- (reply lines of a query, of any other command), echo excluded
+  acknowledge -- reply to a command which is not a query, if not echoed
+  replies -- expected reply of other commands: a string, a compiled
+    regular expression or a tuple of these
+  status -- dictionary of status code: meaning
+  errors -- dictionary of fault code: name
+  timeout -- minutes allowed to reach power lock
+  transitions -- ordered list of ((state, inputs), (new state, output,
+    action)) as for TransitionTable, where action names a command list
+'''
+
+from re import compile
+
+class Bits:
+  '''Pattern of status bits of 1, 0 and x (don't care), e.g. Bits('0x11')
+
+  Compiled into a mask of the bits to compare and their value, so any width
+  of status word is matched in constant time.  Inputs wider than the
+  pattern do not match.
+  '''
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self.mask = (-1 << len(pattern)) | \
+                int(pattern.replace('0', '1').replace('x', '0'), 2)
+    self.value = int(pattern.replace('x', '0'), 2)
+
+
+class TransitionTable:
+  '''State transitions looked up by (state, (input,))
+
+  Built from an ordered list of ((state, inputs), (new state, output,
+  action)) where inputs is either a tuple of exact status strings or a
+  `Bits` pattern.  Lasers reading several status values give each exact
+  input as a tuple of strings, looked up by (state, (input, input, ...)).
+  Exact inputs are found in a dictionary.  Otherwise the patterns of the
+  state are tried in the order given and the first match wins, the result
+  being remembered for the next lookup.
+  '''
+  def __init__(self, shorthand):
+    self.exact = {}
+    self.patterns = {}
+    for (state, inputs), transition in shorthand:
+      if isinstance(inputs, Bits):
+        self.patterns.setdefault(state, []).append(
+          (inputs.mask, inputs.value, transition))
+      else:
+        for input in inputs:
+          if not isinstance(input, tuple):
+            input = (input,)
+          self.exact.setdefault((state, input), transition)
+
+  def __getitem__(self, key):
+    try:
+      return self.exact[key]
+    except KeyError:
+      pass
+    state, inputs = key
+    # serial_check() gives False for a garbled reply, which int() would
+    # read as 0 and match a pattern
+    if not inputs or not isinstance(inputs[0], basestring):
+      raise KeyError(key)
+    try:
+      number = int(inputs[0])
+    except ValueError:
+      raise KeyError(key)
+    for mask, value, transition in self.patterns.get(state, ()):
+      if number & mask == value:
+        self.exact[key] = transition
+        return transition
+    raise KeyError(key)
+
+
+MATCHERS = {} # frozen expected reply: matcher, shared by all lasers
+
+def freeze(expected):
+  if isinstance(expected, (list, tuple)):
+    return tuple([freeze(item) for item in expected])
+  return expected
+
+def matcher(expected):
+  '''Function telling if a stripped reply line is the `expected` reply.
+
+  `expected` is a string, a compiled regular expression or a list or tuple
+  of either, any of which may match.  Strings are found in a set, so the
+  cost does not grow with the number of replies allowed.  Matchers are
+  compiled once and shared.
+  '''
+  key = freeze(expected)
+  try:
+    return MATCHERS[key]
+  except KeyError:
+    pass
+  if not isinstance(key, tuple):
+    key = (key,)
+  exact = frozenset([str(item) for item in key if not hasattr(item, 'match')])
+  patterns = [item for item in key if hasattr(item, 'match')]
+  if patterns:
+    def match(line):
+      if line in exact:
+        return True
+      for pattern in patterns:
+        if pattern.match(line):
+          return True
+      return False
+  else:
+    match = exact.__contains__
+  MATCHERS[freeze(expected)] = match
+  return match
+
+def codes(first, last):
+  '''Status codes first to last as strings, e.g. codes(1, 4)'''
+  return tuple([str(code) for code in range(first, last + 1)])
+
+
+class Protocol:
+  '''Spec of a laser family compiled for fast encoding and matching'''
+  def __init__(self, spec, terminator='\r\n'):
+    self.spec = spec
+    self.terminator = terminator
+    self.commands = dict(spec['commands'])
+    self.identify, identity = spec['identify']
+    self.identity = compile(identity)
+    self.serial = spec.get('serial', self.identify)
+    self.wavelength = spec.get('wavelength')
+    self.echo = spec['echo']
+    self.query = compile(spec['query'])
+    self.acknowledge = spec.get('acknowledge')
+    self.replies = spec.get('replies', {})
+    self.status = spec.get('status', {})
+    self.errors = dict([(str(code), name) for code, name in
+                        spec.get('errors', {}).items()])
+    self.timeout = spec.get('timeout', 3)
+    self.encoded = {}  # command: bytes written
+    self.lines = {}    # command: lines of its complete reply
+    self.expected = {} # command: expected reply
+    known = [self.identify, self.serial]
+    if self.wavelength is not None:
+      known.append(self.wavelength)
+    for command_list in self.commands.values():
+      known.extend(command_list)
+    for command in known:
+      self.compile_command(command)
+    self.transitions = TransitionTable([
+      (condition, (state, output, self.commands.get(action)))
+      for condition, (state, output, action) in spec['transitions']])
+
+  def compile_command(self, command):
+    query_lines, set_lines = self.spec['lines']
+    self.encoded[command] = command + self.terminator
+    if self.query.match(command):
+      lines = query_lines
+    else:
+      lines = set_lines
+    if self.echo:
+      lines += 1
+    self.lines[command] = lines
+    expected = self.replies.get(command)
+    if expected is None:
+      if self.echo:
+        expected = command
+      else:
+        expected = self.acknowledge
+    self.expected[command] = expected
+    if expected is not None:
+      matcher(expected)
+
+  def encode(self, command):
+    try:
+      return self.encoded[command]
+    except KeyError:
+      self.compile_command(command)
+      return self.encoded[command]
+
+  def reply_lines(self, command):
+    try:
+      return self.lines[command]
+    except KeyError:
+      self.compile_command(command)
+      return self.lines[command]
+
+  def expect(self, command_list):
+    '''List of the expected reply of each command'''
+    for command in command_list:
+      if command not in self.expected:
+        self.compile_command(command)
+    return [self.expected[command] for command in command_list]
+
+  def decode_error(self, reply):
+    '''Name of the fault `reply` reports, or the reply itself'''
+    return self.errors.get(reply, reply)
+
+
+SAPPHIRE = {
+  'commands': {
+    'INIT': ['>=0', 'L=1'],
+    'ON': ['L=1'],
+    'OFF': ['L=0'],
+    'CHECK_STATUS': ['?STA'],
+    'CHECK_ERROR': ['?F'],
+  },
+  'identify': ('?HID', r'^\w+$'), # head serial number
+  'wavelength': '?WAVELENGTH',
+  'echo': True,
+  'query': r'\?',
+  'lines': (1, 0),
+  'replies': {
+    '?STA': codes(1, 6),
+  },
+  'status': {
+    '1': 'Start up', '2': 'Warm up', '3': 'Standby', '4': 'Laser on',
+    '5': 'Laser ready', '6': 'Interlock error',
+  },
+  'errors': {
+    '1': 'Interlock',
+  },
+  'timeout': 5,
+  'transitions': [
+    (('s0', ('6',)), ('s1', 1, 'INIT')),
+    (('s0', codes(1, 4)), ('s2', 1, 'ON')),
+    (('s0', ('5',)), ('s3', 1, None)),
+    (('s1', codes(1, 4)), ('s2', 1, 'ON')),
+    (('s1', ('5',)), ('s3', 1, None)),
+    (('s1', ('6',)), ('s4', 0, None)),
+    (('s2', ('5',)), ('s3', 1, None)),
+    (('s2', codes(1, 4)), ('s2', 1, 'ON')),
+    (('s2', ('6',)), ('s2', 0, None)),
+    (('s3', ('5',)), ('s3', 1, None)),
+    (('s3', ('6',)), ('s3', 0, None)),
+    (('s3', codes(1, 4)), ('s3', 0, None)),
+  ],
+}
+
+# Coherent Cube: same command set as the Sapphire, but ?STA reports
+# 1 = Warm up, 2 = Standby, 3 = Laser on, 4 = Error, 5 = Fault, 6 = Sleep
+CUBE = {
+  'commands': {
+    'INIT': ['>=0', 'CW=1', 'L=1'],
+    'ON': ['L=1'],
+    'OFF': ['L=0'],
+    'CHECK_STATUS': ['?STA'],
+    'CHECK_ERROR': ['?F'],
+  },
+  # The CDRH delay setting, since a Sapphire answers ?HID as well
+  'identify': ('?CDRH', r'^[01]$'),
+  'serial': '?HID',
+  'wavelength': '?WAVELENGTH',
+  'echo': True,
+  'query': r'\?',
+  'lines': (1, 0),
+  'replies': {
+    '?STA': codes(1, 6),
+  },
+  'status': {
+    '1': 'Warm up', '2': 'Standby', '3': 'Laser on', '4': 'Error',
+    '5': 'Fault', '6': 'Sleep',
+  },
+  'errors': {
+    '1': 'Interlock',
+  },
+  'timeout': 5,
+  'transitions': [
+    (('s0', ('5',)), ('s1', 1, 'INIT')),
+    (('s0', ('1',)), ('s2', 1, None)),
+    (('s0', ('2', '6')), ('s2', 1, 'ON')),
+    (('s0', ('3',)), ('s3', 1, None)),
+    (('s0', ('4',)), ('s4', 0, None)),
+    (('s1', ('1',)), ('s2', 1, None)),
+    (('s1', ('2', '6')), ('s2', 1, 'ON')),
+    (('s1', ('3',)), ('s3', 1, None)),
+    (('s1', ('4', '5')), ('s4', 0, None)),
+    (('s2', ('1',)), ('s2', 1, None)),
+    (('s2', ('2', '6')), ('s2', 1, 'ON')),
+    (('s2', ('3',)), ('s3', 1, None)),
+    (('s2', ('4', '5')), ('s4', 0, None)),
+    (('s3', ('3',)), ('s3', 1, None)),
+    (('s3', codes(1, 2) + codes(4, 6)), ('s3', 0, None)),
+  ],
+}
+
+# Cobolt generation 4: the leds? bitfield reads 7 = Interlock error,
+# 15 = Stabilizing temperature, 13 = Starting laser, 12 = Warm up and
+# 8 = Output power locked
+COBOLT4 = {
+  'commands': {
+    'INIT': ['cf'],
+    'ON': ['lten1', 'xten1', '@cob 1', 'l1'],
+    'OFF': ['l0'],
+    'CHECK_STATUS': ['leds?'],
+    'CHECK_ERROR': ['f?'],
+  },
+  # The LED bitfield, since a generation 3 answers sn? as well
+  'identify': ('leds?', r'^\d+$'),
+  'serial': 'sn?',
+  'wavelength': 'wl?',
+  'echo': False,
+  'query': r'.*\?$',
+  'lines': (1, 1),
+  'acknowledge': 'OK',
+  'replies': {
+    'leds?': codes(0, 15),
+  },
+  'status': {
+    '7': 'Interlock error', '15': 'Stabilizing temperature',
+    '13': 'Starting laser', '12': 'Warm up', '8': 'Output power locked',
+  },
+  'errors': {
+    '3': 'Interlock',
+  },
+  'transitions': [
+    (('s0', Bits('0xxx')), ('s1', 1, 'INIT')),
+    (('s0', Bits('11xx')), ('s2', 1, None)),
+    (('s0', Bits('10xx')), ('s3', 1, None)),
+    (('s1', Bits('11xx')), ('s2', 1, 'ON')),
+    (('s1', Bits('10xx')), ('s2', 1, None)),
+    (('s1', Bits('0xxx')), ('s4', 0, None)),
+    (('s2', Bits('10xx')), ('s3', 1, None)),
+    (('s2', Bits('11xx')), ('s2', 1, None)),
+    (('s2', Bits('0xxx')), ('s4', 0, None)),
+    (('s3', Bits('10xx')), ('s3', 1, None)),
+    (('s3', Bits('11xx')), ('s4', 0, None)),
+    (('s3', Bits('0xxx')), ('s4', 0, None)),
+  ],
+}
+
+# Cobolt generation 3 has no leds? query, so its state is read from the
+# fault f? (0 = None, 1 = Temperature, 3 = Interlock, 4 = Constant power
+# time out) together with the laser on state l? (0 = Off, 1 = On)
+COBOLT3 = {
+  'commands': {
+    'INIT': ['cf', '@cob1'],
+    'ON': ['l1'],
+    'OFF': ['l0'],
+    'CHECK_STATUS': ['f?', 'l?'],
+    'CHECK_ERROR': ['f?'],
+  },
+  'identify': ('sn?', r'^\d+$'),
+  'echo': False,
+  'query': r'.*\?$',
+  'lines': (1, 1),
+  'acknowledge': 'OK',
+  'replies': {
+    'f?': ('0', '1', '3', '4'),
+    'l?': ('0', '1'),
+  },
+  'status': {
+    ('0', '0'): 'Laser off', ('0', '1'): 'Laser on',
+    ('3', '0'): 'Interlock open',
+  },
+  'errors': {
+    '1': 'Temperature error', '3': 'Interlock',
+    '4': 'Constant power time out',
+  },
+  'transitions': [
+    (('s0', (('0', '1'),)), ('s3', 1, None)),
+    (('s0', (('0', '0'),)), ('s2', 1, 'ON')),
+    (('s0', (('3', '0'), ('3', '1'))), ('s1', 1, 'INIT')),
+    (('s0', (('1', '0'), ('1', '1'), ('4', '0'), ('4', '1'))),
+     ('s4', 0, None)),
+    (('s1', (('0', '1'),)), ('s3', 1, None)),
+    (('s1', (('0', '0'),)), ('s2', 1, 'ON')),
+    (('s1', (('3', '0'), ('3', '1'), ('1', '0'), ('1', '1'), ('4', '0'),
+             ('4', '1'))), ('s4', 0, None)),
+    (('s2', (('0', '1'),)), ('s3', 1, None)),
+    (('s2', (('0', '0'),)), ('s2', 1, None)),
+    (('s2', (('3', '0'), ('3', '1'), ('1', '0'), ('1', '1'), ('4', '0'),
+             ('4', '1'))), ('s4', 0, None)),
+    (('s3', (('0', '1'),)), ('s3', 1, None)),
+    (('s3', (('0', '0'), ('3', '0'), ('3', '1'), ('1', '0'), ('1', '1'),
+             ('4', '0'), ('4', '1'))), ('s3', 0, None)),
+  ],
+}
@@ -0,0 +1,180 @@
+'''
+Command line control of the laser launch
+
+Subcommands:
+  status       power lock of the lasers already identified, and with --io
+               the interlock and shutter inputs
+  identify     find which COM port holds each laser of the sled
+  start        bring up the launch, see launch.py
+  leds         light the front panel LEDs of the given lasers
+  dump-eeprom  save the EEPROM image of the board, or print the sled
+
+Each subcommand imports and opens only the backends it needs.  `status`
+reads the ports from the identity cache written by `identify` and `start`
+and sends one status query per laser, without reading the sled EEPROM or
+scanning the registry, so it is cheap enough to call before every
+acquisition.  The exit status is 0 when the lasers are locked, or the
+subcommand succeeded.
+
+Example:
+    python pyalc.py identify
+    python pyalc.py status --io
+    python pyalc.py dump-eeprom combiner.bin
+'''
+
+from optparse import OptionParser
+from threading import Thread
+import sys
+
+USAGE = '%prog [options] status|identify|start|leds|dump-eeprom [args]'
+
+def query_status(laser, timeout):
+  '''(status, meaning, lock) of `laser` from one reading of CHECK_STATUS,
+  lock being 'locked', 'unlocked' or 'no reply' '''
+  laser.ser.timeout = timeout
+  status = []
+  for command in laser.CHECK_STATUS:
+    status.extend(laser.query(command)[:1])
+  status = tuple(status)
+  try:
+    next_state, expected_state, next_command = \
+      laser.TRANSITION_MATRIX['s3', status]
+    lock = 'locked'
+    if not expected_state:
+      lock = 'unlocked'
+  except KeyError:
+    lock = 'no reply'
+  if len(status) == 1:
+    status = status[0]
+  return status, laser.STATUS.get(status, ''), lock
+
+def status(options, args):
+  from session import SessionManager, IDENTITY_CACHE
+  sessions = SessionManager(options.identity_file or IDENTITY_CACHE)
+  ports = sorted(sessions.identities)
+  if not ports:
+    print '(WW) No lasers identified yet, run identify or start first'
+    return 1
+  results = {}
+
+  def worker(port):
+    try:
+      results[port] = query_status(sessions.laser(port), options.timeout)
+    except Exception, error:
+      print '(EE)', port, 'status query failed:', error
+
+  threads = [Thread(target=worker, args=(port,)) for port in ports]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  sessions.close()
+
+  locked = True
+  for port in ports:
+    identity = sessions.identity(port)
+    reply, meaning, lock = results.get(port, (None, '', 'no reply'))
+    locked = locked and lock == 'locked'
+    print '%-6s %-16s %4s %-10s %-8s %s' % (port, identity['family'],
+      identity['wavelength'], identity['serial'], lock, meaning or reply)
+  if options.io:
+    from devasys import Usb2i2cio, IO_INPUTS
+    board = Usb2i2cio(instance=options.board)
+    data = board.read_io_ports()
+    for name in sorted(IO_INPUTS):
+      print '%-9s %s' % (name, ('low', 'high')[bool(data & IO_INPUTS[name])])
+  if locked:
+    return 0
+  return 1
+
+def identify(options, args):
+  from devasys import Microcontroller, EEPROM_CACHE
+  from prolific import ProlificPorts
+  from session import SessionManager, IDENTITY_CACHE
+  micro = Microcontroller(options.cache_file or EEPROM_CACHE,
+                          instance=options.board)
+  sessions = SessionManager(options.identity_file or IDENTITY_CACHE)
+  try:
+    mapping = sessions.probe(ProlificPorts().COM, micro.eeprom,
+                             refresh=options.refresh)
+  finally:
+    micro.leds.close()
+    sessions.close()
+  for port in sorted(mapping):
+    identity = mapping[port]
+    print '%-6s laser %d %-16s %4s %s' % (port, identity['laser'],
+      identity['family'], identity['wavelength'], identity['serial'])
+  if len(mapping) < micro.eeprom['LASERS_BCD']:
+    return 1
+  return 0
+
+def start(options, args):
+  from devasys import EEPROM_CACHE
+  from launch import Launch
+  from session import IDENTITY_CACHE
+  launch = Launch(cache_file=options.cache_file or EEPROM_CACHE,
+                  identity_file=options.identity_file or IDENTITY_CACHE)
+  try:
+    succeeded = launch.run()
+    launch.report()
+  finally:
+    launch.close()
+  if succeeded:
+    return 0
+  return 1
+
+def leds(options, args):
+  from devasys import Microcontroller
+  try:
+    lasers = [int(arg) for arg in args]
+  except ValueError:
+    print '(EE) leds takes the numbers of the lasers to light, e.g. 1 3'
+    return 2
+  micro = Microcontroller(read_sled=False, instance=options.board)
+  micro.set_active_leds(*lasers)
+  micro.leds.close()
+  return 0
+
+def dump_eeprom(options, args):
+  from eeprom import EEPROM_SIZE
+  from devasys import Microcontroller
+  micro = Microcontroller(read_sled=False, instance=options.board)
+  try:
+    if args:
+      micro.read_EEPROM(0, EEPROM_SIZE, save_file=args[0])
+      return 0
+    sled = micro.read_sled_EEPROM()
+  finally:
+    micro.leds.close()
+  padding = max([len(attr) for attr in sled])
+  for attr in sorted(sled):
+    print str(attr).rjust(padding), ':', sled[attr]
+  return 0
+
+COMMANDS = {
+  'status': status,
+  'identify': identify,
+  'start': start,
+  'leds': leds,
+  'dump-eeprom': dump_eeprom,
+}
+
+def main(argv=None):
+  parser = OptionParser(usage=USAGE)
+  parser.add_option('--board', type='int', default=0,
+                    help='DeVaSys board to use, counting from 0 [%default]')
+  parser.add_option('--cache-file', help='sled EEPROM cache')
+  parser.add_option('--identity-file', help='cache of laser identities')
+  parser.add_option('--timeout', type='float', default=0.2,
+                    help='seconds to wait for a status reply [%default]')
+  parser.add_option('--io', action='store_true', default=False,
+                    help='status also reads the interlock and shutter')
+  parser.add_option('--refresh', action='store_true', default=False,
+                    help='identify probes even ports with a known laser')
+  options, args = parser.parse_args(argv)
+  if not args or args[0] not in COMMANDS:
+    parser.error('expected one of: ' + ', '.join(sorted(COMMANDS)))
+  return COMMANDS[args[0]](options, args[1:])
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,398 @@
+'''
+Record serial and i2c sessions to a binary log and replay them
+
+A Recorder wraps the serial links of the lasers and the DeVaSys library and
+appends every exchange, timestamped, to one log file.  ReplaySerial and
+ReplayUsbI2cIo feed a log back in place of the hardware, either in real time
+or as fast as possible, so `Laser.run()` and `Microcontroller` can be run
+over traces taken in the field without waiting minutes for warm up.
+
+Example:
+>>> recorder = Recorder('launch.log')
+>>> micro = Microcontroller(lib=recorder.usbi2cio())
+>>> laser2 = Sapphire('COM202', recorder.open_serial('COM202'))
+>>> laser2.run()
+>>> recorder.close()
+... later, without the launch ...
+>>> laser2 = replay_laser(Sapphire, 'launch.log', 'COM202')
+>>> laser2.run()
+'s3'
+
+Log format, little endian:
+  header -- MAGIC
+  record -- time (double, seconds since the epoch), channel (B),
+            event (B), payload length (H), payload
+A CHANNEL event names the serial port or board its channel number stands
+for, from there on in the file.  Logs are only ever appended to, so several
+sessions can share a file.
+'''
+
+from struct import Struct
+from threading import Lock
+from time import time, sleep
+
+from laser import open_serial
+from simulator import SimulatedSerial, SimulatedUsbI2cIo, deref, value
+from eeprom import EEPROM_SIZE
+
+MAGIC = 'pyALClog\x01'
+RECORD = Struct('<dBBH')
+I2C = Struct('<fBBHh')   # seconds taken, type, device, memory address, count
+IO = Struct('<fLL')      # seconds taken, data, mask
+
+# Events
+CHANNEL = 0     # payload is the channel name
+WRITE = 1       # serial data written
+READ = 2        # serial line read, empty on timeout
+I2C_READ = 16   # I2C header, data read
+I2C_WRITE = 17  # I2C header with bytes written as count, data
+IO_CONFIG = 18  # IO header, mask unused
+IO_WRITE = 19   # IO header
+IO_READ = 20    # IO header, mask unused
+
+DEVASYS = 'usbi2cio' # default channel of the DeVaSys board
+
+class Recorder:
+  '''Append the traffic of wrapped serial links and boards to `path`'''
+  def __init__(self, path):
+    self.file = open(path, 'ab')
+    self.file.seek(0, 2)
+    if self.file.tell() == 0:
+      self.file.write(MAGIC)
+    self.lock = Lock()
+    self.channels = {} # name: number
+
+  def channel(self, name):
+    '''Number standing for `name` in this session'''
+    self.lock.acquire()
+    try:
+      if name not in self.channels:
+        number = len(self.channels)
+        if number > 0xFF:
+          raise ValueError('(EE) Too many channels to record ' + name)
+        self.channels[name] = number
+        self.file.write(RECORD.pack(time(), number, CHANNEL, len(name)) + name)
+      return self.channels[name]
+    finally:
+      self.lock.release()
+
+  def log(self, channel, event, payload='', now=None):
+    if now is None:
+      now = time()
+    self.lock.acquire()
+    try:
+      self.file.write(RECORD.pack(now, channel, event, len(payload)) + payload)
+    finally:
+      self.lock.release()
+
+  def serial(self, port, ser):
+    '''Record the already opened serial link `ser` of `port`'''
+    return RecordingSerial(self, port, ser)
+
+  def open_serial(self, port, *args, **kwargs):
+    '''laser.open_serial() recording the port, e.g. as a SessionManager
+    opener'''
+    return self.serial(port, open_serial(port, *args, **kwargs))
+
+  def usbi2cio(self, lib=None, name=DEVASYS):
+    '''Record the DAPI calls to `lib`, by default usbi2cio.dll'''
+    if lib is None:
+      from ctypes import windll
+      lib = windll.LoadLibrary('usbi2cio.dll')
+    return RecordingUsbI2cIo(self, lib, name)
+
+  def flush(self):
+    self.lock.acquire()
+    self.file.flush()
+    self.lock.release()
+
+  def close(self):
+    self.lock.acquire()
+    self.file.close()
+    self.lock.release()
+
+class RecordingSerial(object):
+  '''Serial link logging what is written and every line read'''
+  def __init__(self, recorder, port, ser):
+    self.recorder = recorder
+    self.port = port
+    self.ser = ser
+    self.channel = recorder.channel(port)
+
+  def write(self, data):
+    self.recorder.log(self.channel, WRITE, data)
+    return self.ser.write(data)
+
+  def readline(self):
+    line = self.ser.readline()
+    self.recorder.log(self.channel, READ, line)
+    return line
+
+  def readlines(self):
+    lines = []
+    line = self.readline()
+    while line:
+      lines.append(line)
+      line = self.readline()
+    return lines
+
+  def inWaiting(self):
+    return self.ser.inWaiting()
+
+  def flushInput(self):
+    return self.ser.flushInput()
+
+  def setRTS(self, level=1):
+    return self.ser.setRTS(level)
+
+  def setDTR(self, level=1):
+    return self.ser.setDTR(level)
+
+  def isOpen(self):
+    return self.ser.isOpen()
+
+  def close(self):
+    self.ser.close()
+
+  def get_timeout(self):
+    return self.ser.timeout
+
+  def set_timeout(self, timeout):
+    self.ser.timeout = timeout
+
+  timeout = property(get_timeout, set_timeout)
+
+class RecordingUsbI2cIo:
+  '''DeVaSys library logging i2c transactions and I/O port access'''
+  def __init__(self, recorder, lib, name=DEVASYS):
+    self.recorder = recorder
+    self.lib = lib
+    self.channel = recorder.channel(name)
+
+  def __getattr__(self, name):
+    return getattr(self.lib, name) # calls which are not recorded
+
+  def DAPI_ReadI2c(self, handle, p_trans):
+    start = time()
+    length_chk = self.lib.DAPI_ReadI2c(handle, p_trans)
+    trans = deref(p_trans)
+    data = str(bytearray(trans.Data[:max(length_chk, 0)]))
+    self.recorder.log(self.channel, I2C_READ,
+                      I2C.pack(time() - start, trans.byTransType,
+                               trans.bySlvDevAddr, trans.wMemoryAddr,
+                               length_chk) + data, start)
+    return length_chk
+
+  def DAPI_WriteI2c(self, handle, p_trans):
+    start = time()
+    length_chk = self.lib.DAPI_WriteI2c(handle, p_trans)
+    trans = deref(p_trans)
+    data = str(bytearray(trans.Data[:trans.wCount]))
+    self.recorder.log(self.channel, I2C_WRITE,
+                      I2C.pack(time() - start, trans.byTransType,
+                               trans.bySlvDevAddr, trans.wMemoryAddr,
+                               length_chk) + data, start)
+    return length_chk
+
+  def DAPI_ConfigIoPorts(self, handle, ioconf):
+    start = time()
+    result = self.lib.DAPI_ConfigIoPorts(handle, ioconf)
+    self.recorder.log(self.channel, IO_CONFIG,
+                      IO.pack(time() - start, value(ioconf), 0), start)
+    return result
+
+  def DAPI_WriteIoPorts(self, handle, iodata, iomask):
+    start = time()
+    result = self.lib.DAPI_WriteIoPorts(handle, iodata, iomask)
+    self.recorder.log(self.channel, IO_WRITE,
+                      IO.pack(time() - start, value(iodata), value(iomask)),
+                      start)
+    return result
+
+  def DAPI_ReadIoPorts(self, handle, p_data):
+    start = time()
+    result = self.lib.DAPI_ReadIoPorts(handle, p_data)
+    self.recorder.log(self.channel, IO_READ,
+                      IO.pack(time() - start, deref(p_data).value, 0), start)
+    return result
+
+def read_log(path):
+  '''List of (time, channel name, event, payload) recorded in `path`'''
+  f = open(path, 'rb')
+  data = f.read()
+  f.close()
+  if not data.startswith(MAGIC):
+    raise ValueError('(EE) Not a pyALC log: ' + path)
+  records = []
+  names = {} # channel number: name, as last defined
+  offset = len(MAGIC)
+  while offset + RECORD.size <= len(data):
+    now, channel, event, length = RECORD.unpack_from(data, offset)
+    offset = offset + RECORD.size
+    payload = data[offset:offset + length]
+    offset = offset + length
+    if len(payload) < length:
+      print '(WW) Ignoring truncated record at the end of', path
+      break
+    if event == CHANNEL:
+      names[channel] = payload
+      continue
+    records.append((now, names.get(channel), event, payload))
+  return records
+
+def channels(path, events=(WRITE, READ)):
+  '''Names of the channels with any of `events` in the log'''
+  names = []
+  for now, name, event, payload in read_log(path):
+    if event in events and name not in names:
+      names.append(name)
+  return names
+
+class ReplaySerial(SimulatedSerial):
+  '''Serial link answering each write with the lines recorded after it
+
+  Writes are expected in the order they were recorded; a different command
+  is warned about and answered as recorded.  When not in `realtime` the
+  lines are available immediately, reads of a silent link return without
+  waiting, and `time()` follows the clock of the recording so timeouts of
+  the state machine still apply.
+  '''
+  def __init__(self, path, port=None, realtime=False, timeout=1):
+    SimulatedSerial.__init__(self, latency=0, timeout=timeout)
+    if port is None:
+      port = (channels(path) or [None])[0]
+    self.port = port
+    self.realtime = realtime
+    self.exchanges = [] # (time written, data, [(time read, line)])
+    for now, name, event, payload in read_log(path):
+      if name != port:
+        continue
+      if event == WRITE:
+        self.exchanges.append((now, payload, []))
+      elif event == READ and payload and self.exchanges:
+        self.exchanges[-1][2].append((now, payload))
+    self.next = 0
+    self.now = 0.0
+    if self.exchanges:
+      self.now = self.exchanges[0][0]
+
+  def write(self, data):
+    now = time()
+    self.condition.acquire()
+    try:
+      if self.next >= len(self.exchanges):
+        if self.next == len(self.exchanges):
+          print '(WW) Replay of', self.port, 'ran out of recorded writes'
+          self.next = self.next + 1
+        return len(data)
+      written, recorded, lines = self.exchanges[self.next]
+      self.next = self.next + 1
+      if data != recorded:
+        print '(WW) Replay of', self.port, 'expected', repr(recorded), \
+              'but got', repr(data)
+      self.commands.extend([command for command in data.split('\r\n')
+                            if command])
+      self.now = written
+      for read, line in lines:
+        if self.realtime:
+          arrival = now + read - written
+          self.lines.append((arrival, arrival, line))
+        else:
+          self.lines.append((0, read, line))
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+    return len(data)
+
+  def readline(self):
+    if self.realtime:
+      return SimulatedSerial.readline(self)
+    self.condition.acquire()
+    try:
+      if not self.lines:
+        self.now = self.now + self.timeout # as if the read had timed out
+        return ''
+      start, self.now, line = self.lines.pop(0)
+      return line
+    finally:
+      self.condition.release()
+
+  def time(self):
+    '''Seconds since the epoch, of the recording when not in real time'''
+    if self.realtime:
+      return time()
+    return self.now
+
+  def sleep(self, seconds):
+    if self.realtime:
+      sleep(seconds)
+
+class ReplayUsbI2cIo(SimulatedUsbI2cIo):
+  '''DeVaSys board holding the EEPROM contents and input levels recorded
+
+  The EEPROM image is built from every recorded read and write, unrecorded
+  bytes reading as 0xFF, so the sled can be read back in any order or chunk
+  size.  I/O port reads return the recorded levels in turn, or in
+  `realtime` the level recorded at the same time since the board was
+  opened, with transactions paced like the recorded bus.
+  '''
+  def __init__(self, path, name=DEVASYS, realtime=False):
+    SimulatedUsbI2cIo.__init__(self, '\xff' * EEPROM_SIZE, latency=0,
+                               byte_time=0)
+    self.realtime = realtime
+    self.io_reads = [] # (seconds since first record, data)
+    first = None
+    samples = []       # (seconds taken, bytes) of each i2c transaction
+    for now, channel, event, payload in read_log(path):
+      if channel != name:
+        continue
+      if first is None:
+        first = now
+      if event in (I2C_READ, I2C_WRITE):
+        elapsed, byTransType, bySlvDevAddr, wMemoryAddr, count = \
+          I2C.unpack_from(payload)
+        data = payload[I2C.size:]
+        samples.append((elapsed, len(data)))
+        if bySlvDevAddr != 0xA2 or count <= 0:
+          continue
+        if event == I2C_WRITE:
+          data = data[:count]
+        self.eeprom[wMemoryAddr:wMemoryAddr + len(data)] = data
+      elif event == IO_READ:
+        elapsed, data, mask = IO.unpack_from(payload)
+        self.io_reads.append((now - first, data))
+    if realtime and samples:
+      # Fit the recorded transactions to the simulated bus timing
+      self.latency = min([elapsed for elapsed, size in samples])
+      total = sum([size for elapsed, size in samples])
+      if total:
+        self.byte_time = max(0.0, sum([elapsed - self.latency
+                                       for elapsed, size in samples]) /
+                                  total)
+    self.next = 0
+    self.opened = time()
+
+  def DAPI_ReadIoPorts(self, handle, p_data):
+    SimulatedUsbI2cIo.DAPI_ReadIoPorts(self, handle, p_data)
+    if not self.io_reads:
+      return 1
+    if self.realtime:
+      elapsed = time() - self.opened
+      while self.next + 1 < len(self.io_reads) and \
+            self.io_reads[self.next + 1][0] <= elapsed:
+        self.next = self.next + 1
+      deref(p_data).value = self.io_reads[self.next][1]
+    else:
+      deref(p_data).value = self.io_reads[min(self.next,
+                                              len(self.io_reads) - 1)][1]
+      self.next = self.next + 1
+    return 1
+
+def replay_laser(laser_class, path, port=None, realtime=False):
+  '''Laser of `laser_class` talking to the recording of `port` in `path`,
+  its run() following the clock of the recording unless in `realtime`'''
+  ser = ReplaySerial(path, port, realtime)
+  laser = laser_class(ser.port, ser)
+  laser.time = ser.time
+  laser.sleep = ser.sleep
+  return laser
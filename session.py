@@ -0,0 +1,307 @@
+'''
+Keep laser serial links open across runs and remember which laser is where
+
+Opening a COM port and toggling RTS/DTR for every `Laser` costs time, and a
+USB-serial squid dropping off the bus leaves the laser unusable.  The
+SessionManager hands out one ReconnectingSerial per port, which reopens the
+port and repeats the operation when it fails, and keeps an on-disk cache of
+the laser identified on each port so later startups skip identification.
+
+Example:
+>>> sessions = SessionManager()
+>>> sessions.identify('COM202', 'SAPPHIRE', 488, '123456')
+>>> laser = sessions.laser('COM202')   # a Sapphire on a shared link
+>>> laser.run()
+'''
+
+from os.path import expanduser, join
+from cPickle import dump, load
+from time import sleep
+from threading import Thread, RLock
+
+from laser import open_serial, nanometres, FAMILIES, PROBE_ORDER
+
+IDENTITY_CACHE = join(expanduser('~'), '.pyALC_ports.cache')
+IDENTITY_LOCK = RLock() # serializes identity updates from several threads
+
+class ReconnectingSerial(object):
+  '''Serial link which reopens its port after the USB-serial adapter drops
+
+  Any pySerial operation failing with an I/O error closes the port, reopens
+  it with `opener` up to `retries` times `delay` seconds apart, and is then
+  repeated once.  A reply in flight when the link dropped is lost, which the
+  laser code already treats as a glitch.
+  '''
+  def __init__(self, port, opener=open_serial, retries=3, delay=0.5):
+    self.port = port
+    self.opener = opener
+    self.retries = retries
+    self.delay = delay
+    self.reconnects = 0
+    self.ser = opener(port)
+
+  def reconnect(self):
+    '''Close the broken port and open it again'''
+    try:
+      self.ser.close()
+    except (EnvironmentError, ValueError):
+      pass
+    for i in range(self.retries):
+      sleep(self.delay)
+      try:
+        self.ser = self.opener(self.port)
+        self.reconnects = self.reconnects + 1
+        print '(II) Reconnected serial port', self.port
+        return
+      except (EnvironmentError, ValueError):
+        pass
+    raise EnvironmentError('(EE) Could not reopen serial port ' + self.port)
+
+  def call(self, method, *args):
+    try:
+      return getattr(self.ser, method)(*args)
+    except (EnvironmentError, ValueError), error:
+      print '(WW) Serial port', self.port, 'failed:', error
+      self.reconnect()
+      return getattr(self.ser, method)(*args)
+
+  def write(self, data):
+    return self.call('write', data)
+
+  def readline(self):
+    return self.call('readline')
+
+  def readlines(self):
+    return self.call('readlines')
+
+  def inWaiting(self):
+    return self.call('inWaiting')
+
+  def flushInput(self):
+    return self.call('flushInput')
+
+  def setRTS(self, level=1):
+    return self.call('setRTS', level)
+
+  def setDTR(self, level=1):
+    return self.call('setDTR', level)
+
+  def isOpen(self):
+    return self.ser.isOpen()
+
+  def close(self):
+    self.ser.close()
+
+  def get_timeout(self):
+    return self.ser.timeout
+
+  def set_timeout(self, timeout):
+    self.ser.timeout = timeout
+
+  timeout = property(get_timeout, set_timeout)
+
+class SessionManager:
+  '''Shared serial links and cached identities of the lasers on them'''
+  def __init__(self, identity_file=IDENTITY_CACHE, opener=open_serial):
+    '''Set `identity_file` to None to not remember identities on disk.
+    `opener` opens a port by name, e.g. to use simulated lasers.'''
+    self.identity_file = identity_file
+    self.opener = opener
+    self.links = {}      # port: ReconnectingSerial
+    self.lasers = {}     # port: Laser
+    self.identities = {} # port: identity
+    if identity_file is not None:
+      try:
+        f = open(identity_file, 'rb')
+        try:
+          self.identities = load(f)
+        finally:
+          f.close()
+      except IOError:
+        pass # nothing identified yet
+      except Exception:
+        print '(WW) Ignoring unreadable identity cache:', identity_file
+
+  def link(self, port):
+    '''Open serial link of `port`, reused by every later call'''
+    if port not in self.links:
+      self.links[port] = ReconnectingSerial(port, self.opener)
+    return self.links[port]
+
+  def laser(self, port, laser_class=None):
+    '''Laser on `port` using the shared link
+
+    The class is looked up from the cached identity of the port unless
+    `laser_class` is given.  The same Laser is returned for a port on
+    later calls, so its state carries over between runs.
+    '''
+    laser = self.lasers.get(port)
+    if laser is not None and \
+       (laser_class is None or isinstance(laser, laser_class)):
+      return laser
+    if laser_class is None:
+      identity = self.identity(port)
+      if identity is None:
+        raise KeyError('(EE) No laser identified on ' + port)
+      laser_class = FAMILIES[identity['family']]
+    laser = laser_class(port, self.link(port))
+    self.lasers[port] = laser
+    return laser
+
+  def identity(self, port):
+    '''Cached identity of the laser on `port`, or None'''
+    return self.identities.get(port)
+
+  def identify(self, port, family, wavelength=None, serial=None):
+    '''Remember the laser found on `port`'''
+    identity = {'family': family, 'wavelength': wavelength, 'serial': serial}
+    IDENTITY_LOCK.acquire()
+    try:
+      if self.identities.get(port) == identity:
+        return
+      self.identities[port] = identity
+      self.save()
+    finally:
+      IDENTITY_LOCK.release()
+
+  def probe(self, ports, sled, timeout=0.2, refresh=False, quiet=False):
+    '''Find which of `ports` hold the lasers listed in the `sled` EEPROM
+    
+    Every port is probed at the same time, sending the IDENTIFY query of
+    each laser family installed with a short `timeout`, so probing takes
+    about as long as the slowest port instead of the sum of all.  Ports
+    with a cached identity of an installed family are not probed unless
+    `refresh` is set.
+    
+    Arguments:
+    ports -- list of port names, e.g. ProlificPorts().COM
+    sled -- decoded sled EEPROM, e.g. Microcontroller().eeprom
+    
+    Returns dictionary of port: identity, each with the 'laser' number
+    in the sled, 'family', 'wavelength' and 'serial'.  Lasers of the same
+    family are told apart by the wavelength they report.  Lasers which
+    cannot report it are assigned to the remaining lasers of their family
+    in port order, with a warning, and are not cached.  Set `quiet` to
+    leave out the warnings, e.g. when trying sleds which may not be on
+    these ports at all.
+    '''
+    installed = []
+    for i in range(1, sled['LASERS_BCD'] + 1):
+      family = sled['L%d_FAMILY' % i]
+      if family in FAMILIES:
+        installed.append((i, family,
+                          nanometres(sled.get('L%d_WAVELENGTH' % i))))
+      elif not quiet:
+        print '(WW) Cannot probe laser', i, 'of unsupported family', family
+    classes = []
+    for i, family, wavelength in installed:
+      if FAMILIES[family] not in classes:
+        classes.append(FAMILIES[family])
+    classes.sort(key=list(PROBE_ORDER).index)
+    families = [family for i, family, wavelength in installed]
+    
+    found = {} # port: (laser class, serial number, wavelength or None)
+    for port in ports:
+      identity = self.identity(port)
+      if not refresh and identity is not None and \
+         identity['family'] in families:
+        found[port] = (FAMILIES[identity['family']], identity['serial'],
+                       nanometres(identity['wavelength']))
+    
+    def worker(port):
+      try:
+        link = self.link(port)
+      except (EnvironmentError, ValueError), error:
+        if not quiet:
+          print '(WW) Cannot open', port, 'to probe:', error
+        return
+      saved_timeout = link.timeout
+      link.timeout = timeout
+      try:
+        for laser_class in classes:
+          laser = laser_class(port, link)
+          serial = laser.identify()
+          if serial is not None:
+            found[port] = (laser_class, serial, laser.wavelength())
+            self.lasers[port] = laser
+            return
+      finally:
+        link.timeout = saved_timeout
+    
+    threads = [Thread(target=worker, args=(port,))
+               for port in ports if port not in found]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    
+    mapping = {}
+    guessed = [] # ports of lasers not reporting their wavelength
+    for port in ports:
+      if port not in found:
+        continue
+      laser_class, serial, measured = found[port]
+      if measured is None:
+        guessed.append(port)
+        continue
+      for i, family, wavelength in installed:
+        if FAMILIES[family] is laser_class and wavelength == measured:
+          installed.remove((i, family, wavelength))
+          mapping[port] = {'laser': i, 'family': family,
+                           'wavelength': wavelength, 'serial': serial}
+          self.identify(port, family, wavelength, serial)
+          break
+      else:
+        if not quiet:
+          print '(WW) Laser', serial, 'on', port, 'at', measured, \
+                'nm is not in the sled'
+    for port in guessed:
+      laser_class, serial, measured = found[port]
+      for i, family, wavelength in installed:
+        if FAMILIES[family] is laser_class:
+          installed.remove((i, family, wavelength))
+          mapping[port] = {'laser': i, 'family': family,
+                           'wavelength': wavelength, 'serial': serial}
+          if not quiet:
+            print '(WW) Cannot read the wavelength of', port, \
+                  '- assuming laser', i, 'in port order'
+          break
+    if not quiet:
+      for i, family, wavelength in installed:
+        print '(WW) No port found for laser', i, family, wavelength
+    return mapping
+  
+  def forget(self, port):
+    '''Drop the identity of `port`, e.g. after the laser was swapped'''
+    IDENTITY_LOCK.acquire()
+    try:
+      if self.identities.pop(port, None) is not None:
+        self.save()
+    finally:
+      IDENTITY_LOCK.release()
+
+  def save(self):
+    if self.identity_file is None:
+      return
+    IDENTITY_LOCK.acquire()
+    try:
+      self.write()
+    finally:
+      IDENTITY_LOCK.release()
+
+  def write(self):
+    try:
+      f = open(self.identity_file, 'wb')
+      try:
+        dump(self.identities, f, 2)
+      finally:
+        f.close()
+    except IOError:
+      print '(WW) Could not write identity cache:', self.identity_file
+
+  def close(self):
+    '''Close every link'''
+    for link in self.links.values():
+      link.close()
+    self.links = {}
+    self.lasers = {}
@@ -0,0 +1,545 @@
+'''
+Simulate the laser launch hardware in-process
+
+Stand ins for the backends used by the launch, so bring up, polling and
+EEPROM code can be exercised and timed without the hardware or Windows:
+- SimulatedUsbI2cIo replaces usbi2cio.dll for devasys.Usb2i2cio
+- SimulatedRegistry replaces _winreg for prolific.ProlificPorts
+- SimulatedSapphire, SimulatedCube, SimulatedCobolt3 and SimulatedCobolt4
+  replace serial.Serial for the laser classes of the same name
+
+Timing follows the real buses: each USB transaction has a fixed latency,
+i2c bytes take 90 us each at 100 kHz, and serial characters take 10 bits at
+the baud rate.  Set the latencies to 0 to run as fast as possible.
+
+Example:
+>>> from laser import Sapphire
+>>> from simulator import SimulatedSapphire
+>>> laser = Sapphire('COM1', SimulatedSapphire(warmup=0))
+>>> laser.run()
+'s3'
+'''
+
+from ctypes import string_at, memmove, addressof
+from threading import Condition
+from time import time, sleep
+from eeprom import EEPROM_SIZE, LASER_START, LASER_OFFSET, \
+                   BOARD_SERIAL_ADDRESS
+
+SLED = (
+  # wavelength, power, family
+  (405, 100, 'CUBE'),
+  (488, 50, 'SAPPHIRE'),
+  (561, 50, 'COBOLTJIVE4'),
+  (640, 100, 'CUBE'),
+)
+
+def sled_image(lasers=SLED, serial='LC-0533', model='LC-501',
+               modified='2010/02/11', board='DVS0001'):
+  '''EEPROM image of a sled holding `lasers`'''
+  image = bytearray('\xff' * EEPROM_SIZE)
+  def put(address, text):
+    image[address:address + len(text)] = text
+  put(0x2801, 'Andor Technology\x00')
+  put(0x2815, '1\x00')
+  put(0x281F, model + '\x00')
+  put(0x2829, '2009/11/03\x00')
+  put(0x2834, modified + '\x00')
+  put(0x283F, serial + '\x00')
+  put(0x2857, chr(len(lasers)))
+  for i in range(len(lasers)):
+    wavelength, power, family = lasers[i]
+    record = LASER_START + LASER_OFFSET * i
+    put(record, '%s-%d\x00' % (family, wavelength))
+    put(record + 0x10, '%03d%03d' % (wavelength, power))
+    put(record + 0x17, '100000250')  # AOTF 100.000 MHz 25.0 dB
+    put(record + 0x20, family.ljust(16, '\x00'))
+  put(BOARD_SERIAL_ADDRESS, board + '\x00')
+  return str(image)
+
+def deref(pointer):
+  '''Object behind a ctypes pointer() or byref()'''
+  try:
+    return pointer.contents
+  except AttributeError:
+    return pointer._obj
+
+def value(number):
+  '''Integer of a ctypes number or a plain int'''
+  return getattr(number, 'value', number)
+
+class SimulatedUsbI2cIo:
+  '''DeVaSys usb2i2cio board with EEPROM, LED expanders and I/O ports'''
+  def __init__(self, image=None, devices=1, latency=0.001, byte_time=90e-6,
+               inputs=0x48000, images=None, write_cycle=0.005, page=64):
+    '''
+    Keyword Arguments:
+    image -- EEPROM contents as a string, by default a 4 laser sled
+    devices -- number of boards connected, sharing the EEPROM and I/O ports
+    images -- EEPROM contents of each board instead, one board per image
+    write_cycle -- seconds the EEPROM ignores its address after a write
+    page -- bytes of an EEPROM page, writes wrap around within a page
+    latency -- seconds taken by each USB transaction
+    byte_time -- seconds taken by each i2c byte
+    inputs -- level of the input pins, by default interlock (B7) and
+      shutter (C6) high
+    '''
+    if image is None:
+      image = sled_image()
+    if images is None:
+      images = [image]
+    else:
+      devices = len(images)
+    self.eeproms = [bytearray(image) for image in images]
+    self.eeprom = self.eeproms[0]
+    self.devices = devices
+    self.write_cycle = write_cycle
+    self.page = page
+    self.busy_until = 0 # end of the EEPROM write cycle
+    self.latency = latency
+    self.byte_time = byte_time
+    self.inputs = inputs
+    self.ioconf = 0
+    self.iodata = 0
+    self.expanders = {}   # i2c address: last byte written
+    self.transactions = 0
+
+  def load(self, path):
+    '''Use a saved EEPROM image'''
+    f = open(path, 'rb')
+    self.eeprom[:] = f.read()
+    f.close()
+
+  def set_input(self, mask, level):
+    '''Drive input pins `mask` high or low, e.g. to trip the interlock'''
+    if level:
+      self.inputs = self.inputs | mask
+    else:
+      self.inputs = self.inputs & ~mask
+
+  def wait(self, count=0):
+    self.transactions = self.transactions + 1
+    delay = self.latency + count * self.byte_time
+    if delay > 0:
+      sleep(delay)
+
+  def memory(self, handle):
+    '''EEPROM of the board opened as `handle`'''
+    return self.eeproms[(handle - 1) % len(self.eeproms)]
+
+  def DAPI_GetDeviceCount(self, name):
+    return self.devices
+
+  def DAPI_OpenDeviceInstance(self, name, instance):
+    if instance >= self.devices:
+      return -1
+    return instance + 1
+
+  def DAPI_CloseDeviceInstance(self, handle):
+    return 1
+
+  def DAPI_ReadI2c(self, handle, p_trans):
+    trans = deref(p_trans)
+    count = trans.wCount
+    self.wait(count)
+    if trans.bySlvDevAddr != 0xA2:
+      return 0
+    if time() < self.busy_until:
+      return -1 # not acknowledged during write cycle
+    start = trans.wMemoryAddr
+    data = str(self.memory(handle)[start:start + count])
+    memmove(trans.Data, data, len(data))
+    return len(data)
+
+  def DAPI_WriteI2c(self, handle, p_trans):
+    trans = deref(p_trans)
+    count = trans.wCount
+    self.wait(count)
+    data = string_at(addressof(trans.Data), count)
+    if trans.bySlvDevAddr == 0xA2:
+      if time() < self.busy_until:
+        return -1
+      memory = self.memory(handle)
+      page = trans.wMemoryAddr - trans.wMemoryAddr % self.page
+      for i in range(count):
+        address = page + (trans.wMemoryAddr - page + i) % self.page
+        memory[address] = ord(data[i])
+      self.busy_until = time() + self.write_cycle
+    elif count:
+      self.expanders[trans.bySlvDevAddr] = ord(data[-1])
+    return count
+
+  def DAPI_ConfigIoPorts(self, handle, ioconf):
+    self.wait()
+    self.ioconf = value(ioconf)
+    return 1
+
+  def DAPI_WriteIoPorts(self, handle, iodata, iomask):
+    self.wait()
+    iomask = value(iomask)
+    self.iodata = (self.iodata & ~iomask) | (value(iodata) & iomask)
+    return 1
+
+  def DAPI_ReadIoPorts(self, handle, p_data):
+    self.wait()
+    data = (self.iodata & ~self.ioconf) | (self.inputs & self.ioconf)
+    deref(p_data).value = data
+    return 1
+
+class SimulatedRegistry:
+  '''Windows registry holding the Prolific Ser2pl service and its ports'''
+  HKEY_LOCAL_MACHINE = 'HKLM'
+  REG_SZ = 1
+  REG_DWORD = 4
+
+  def __init__(self, squids=(('3298b0e7', ('COM55', 'COM56', 'COM57',
+                                            'COM58')),), arch=32):
+    '''
+    Keyword Arguments:
+    squids -- list of (serial number, COM ports) of each USB-serial squid
+    arch -- 32 or 64 for the Ser2pl or Ser2pl64 driver
+    '''
+    service = {32: 'Ser2pl', 64: 'Ser2pl64'}[arch]
+    enum = 'SYSTEM\\CurrentControlSet\\Services\\' + service + '\\Enum'
+    values = []
+    self.keys = {enum: values}
+    for squid, ports in squids:
+      for i in range(len(ports)):
+        instance = 'USB\\Vid_067b&Pid_2303\\6&' + squid + '&0&' + str(i + 1)
+        values.append((str(len(values)), instance, self.REG_SZ))
+        self.keys['SYSTEM\\CurrentControlSet\\Enum\\' + instance +
+                  '\\Device Parameters'] = [('PortName', ports[i],
+                                             self.REG_SZ)]
+    values.append(('Count', len(values), self.REG_DWORD))
+
+  def OpenKey(self, key, sub_key):
+    if sub_key not in self.keys:
+      raise EnvironmentError(2, 'The system cannot find the file specified')
+    return sub_key
+
+  def QueryValueEx(self, key, value_name):
+    for name, data, type in self.keys[key]:
+      if name == value_name:
+        return data, type
+    raise EnvironmentError(2, 'The system cannot find the file specified')
+
+  def EnumValue(self, key, index):
+    try:
+      return self.keys[key][index]
+    except IndexError:
+      raise EnvironmentError(259, 'No more data is available')
+
+class SimulatedSerial:
+  '''Serial port with a laser on the other end
+
+  Replies to each command are queued with the times they would start and
+  finish arriving.  Subclasses implement `respond()` for a laser protocol.
+  '''
+  def __init__(self, latency=0.002, baud=19200, timeout=1):
+    self.latency = latency
+    self.char_time = 10.0 / baud
+    self.timeout = timeout
+    self.lines = []   # (arrival time, line)
+    self.open = True
+    self.condition = Condition()
+    self.commands = []
+
+  def setRTS(self, level=1):
+    pass
+
+  def setDTR(self, level=1):
+    pass
+
+  def isOpen(self):
+    return self.open
+
+  def close(self):
+    self.open = False
+
+  def flushInput(self):
+    self.condition.acquire()
+    now = time()
+    self.lines = [(start, t, line) for start, t, line in self.lines
+                  if start > now]
+    self.condition.release()
+
+  def inWaiting(self):
+    '''Bytes of lines already being received'''
+    self.condition.acquire()
+    now = time()
+    waiting = sum([len(line) for start, t, line in self.lines
+                   if start <= now])
+    self.condition.release()
+    return waiting
+
+  def write(self, data):
+    now = time()
+    self.condition.acquire()
+    try:
+      arrival = max([now] + [t for start, t, line in self.lines])
+      arrival = arrival + len(data) * self.char_time + self.latency
+      for command in data.split('\r\n'):
+        if not command:
+          continue
+        self.commands.append(command)
+        for line in self.respond(command):
+          start = arrival
+          arrival = arrival + len(line) * self.char_time
+          self.lines.append((start, arrival, line))
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+    return len(data)
+
+  def readline(self):
+    deadline = time() + self.timeout
+    self.condition.acquire()
+    try:
+      while True:
+        now = time()
+        if self.lines and self.lines[0][1] <= now:
+          return self.lines.pop(0)[2]
+        if now >= deadline:
+          return ''
+        if self.lines:
+          wait = min(self.lines[0][1], deadline) - now
+        else:
+          wait = deadline - now
+        self.condition.wait(wait)
+    finally:
+      self.condition.release()
+
+  def readlines(self):
+    lines = []
+    line = self.readline()
+    while line:
+      lines.append(line)
+      line = self.readline()
+    return lines
+
+  def respond(self, command):
+    '''List of lines sent back by the laser for `command`'''
+    return []
+
+class SimulatedSapphire(SimulatedSerial):
+  '''Coherent Sapphire answering ?STA with its warm up progress
+
+  ?STA codes: 1 = St', 2 = Warm up, 3 = Stand by, 4 = Laser on,
+  5 = Laser ready, 6 = Interlock Error
+  '''
+  def __init__(self, warmup=300, interlock=True, faults=(), serial='123456',
+               wavelength=488, **kwargs):
+    '''
+    Keyword Arguments:
+    warmup -- seconds from L=1 until the laser is ready
+    interlock -- False to leave the interlock open
+    faults -- fault names listed after L=1, e.g. ('HDeeprom', 'PSeeprom')
+    '''
+    SimulatedSerial.__init__(self, **kwargs)
+    self.warmup = warmup
+    self.interlock = interlock
+    self.faults = list(faults)
+    self.serial = serial
+    self.wavelength = wavelength
+    self.laser_on = None  # time L=1 was received
+
+  def status(self):
+    if not self.interlock or self.faults:
+      return '6'
+    if self.laser_on is None:
+      return '3'
+    if time() - self.laser_on < self.warmup:
+      return '4'
+    return '5'
+
+  def respond(self, command):
+    reply = [command + '\r\n']
+    if command == 'L=1':
+      if self.faults:
+        reply.append('\r\n')
+        reply.append('Fault(s):\r\n')
+        reply.extend(['\t' + fault + '\r\n' for fault in self.faults])
+      elif self.interlock and self.laser_on is None:
+        self.laser_on = time()
+    elif command == 'L=0':
+      self.laser_on = None
+    elif command == '?STA':
+      reply.append(self.status() + '\r\n')
+    elif command == '?F':
+      if self.faults:
+        reply.append(' '.join(self.faults) + '\r\n')
+      elif not self.interlock:
+        reply.append('Interlock\r\n')
+      else:
+        reply.append('System OK\r\n')
+    elif command == '?HID':
+      reply.append(self.serial + '\r\n')
+    elif command == '?WAVELENGTH':
+      reply.append(str(self.wavelength) + '\r\n')
+    elif not command.startswith('>='):
+      reply.append('Error: Illegal command\r\n')
+    return reply
+
+class SimulatedCube(SimulatedSerial):
+  '''Coherent Cube answering ?STA with its warm up progress
+
+  ?STA codes: 1 = Warm up, 2 = Standby, 3 = Laser on, 4 = Error,
+  5 = Fault, 6 = Sleep
+  '''
+  def __init__(self, warmup=60, interlock=True, serial='654321',
+               wavelength=405, **kwargs):
+    '''
+    Keyword Arguments:
+    warmup -- seconds from L=1 until the laser is on
+    interlock -- False to leave the interlock open
+    '''
+    SimulatedSerial.__init__(self, **kwargs)
+    self.warmup = warmup
+    self.interlock = interlock
+    self.serial = serial
+    self.wavelength = wavelength
+    self.laser_on = None  # time L=1 was received
+
+  def status(self):
+    if not self.interlock:
+      return '5'
+    if self.laser_on is None:
+      return '2'
+    if time() - self.laser_on < self.warmup:
+      return '1'
+    return '3'
+
+  def respond(self, command):
+    reply = [command + '\r\n']
+    if command == 'L=1':
+      if self.interlock and self.laser_on is None:
+        self.laser_on = time()
+    elif command == 'L=0':
+      self.laser_on = None
+    elif command == '?STA':
+      reply.append(self.status() + '\r\n')
+    elif command == '?F':
+      if not self.interlock:
+        reply.append('1\r\n')
+      else:
+        reply.append('0\r\n')
+    elif command == '?CDRH':
+      reply.append('0\r\n')
+    elif command == '?HID':
+      reply.append(self.serial + '\r\n')
+    elif command == '?WAVELENGTH':
+      reply.append(str(self.wavelength) + '\r\n')
+    elif not (command.startswith('>=') or command.startswith('CW=')):
+      reply.append('Error: Illegal command\r\n')
+    return reply
+
+class SimulatedCobolt3(SimulatedSerial):
+  '''Cobolt generation 3 answering f? with its fault and l? with its laser
+  on state, lasing once started with @cob1 or l1
+
+  f? values: 0 = No fault, 3 = Interlock Error
+  '''
+  def __init__(self, warmup=90, interlock=True, serial='1234',
+               wavelength=532, **kwargs):
+    '''
+    Keyword Arguments:
+    warmup -- seconds from start until the laser is on
+    interlock -- False to leave the interlock open
+    '''
+    SimulatedSerial.__init__(self, **kwargs)
+    self.warmup = warmup
+    self.interlock = interlock
+    self.fault = 0
+    if not interlock:
+      self.fault = 3
+    self.serial = serial
+    self.wavelength = wavelength
+    self.laser_on = None
+
+  def respond(self, command):
+    if command == 'f?':
+      return [str(self.fault) + '\r\n']
+    if command == 'l?':
+      if self.laser_on is not None and \
+         time() - self.laser_on >= self.warmup:
+        return ['1\r\n']
+      return ['0\r\n']
+    if command == 'cf':
+      if self.interlock:
+        self.fault = 0
+      return ['OK\r\n']
+    if command in ('l1', '@cob1'):
+      if self.laser_on is None and not self.fault:
+        self.laser_on = time()
+      return ['OK\r\n']
+    if command == 'l0':
+      self.laser_on = None
+      return ['OK\r\n']
+    if command == 'sn?':
+      return [self.serial + '\r\n']
+    return ['Syntax error: illegal command\r\n']
+
+class SimulatedCobolt4(SimulatedSerial):
+  '''Cobolt generation 4 answering leds? with its LED bitfield
+
+  leds? values: 7 = Interlock Error, 15 = Stabilizing Temperature,
+  13 = Starting Laser, 12 = Warm up, 8 = Output power locked
+  '''
+  def __init__(self, stabilize=60, start=30, warmup=90, interlock=True,
+               autostart=True, serial='4321', wavelength=561, **kwargs):
+    '''
+    Keyword Arguments:
+    stabilize, start, warmup -- seconds spent in each phase of start up
+    interlock -- False to leave the interlock open
+    autostart -- False for a laser which waits for l1 before starting
+    '''
+    SimulatedSerial.__init__(self, **kwargs)
+    self.phases = (stabilize, start, warmup)
+    self.interlock = interlock
+    self.fault = 0
+    if not interlock:
+      self.fault = 3
+    self.serial = serial
+    self.wavelength = wavelength
+    self.laser_on = None
+    if autostart:
+      self.laser_on = time()
+
+  def leds(self):
+    if not self.interlock or self.fault:
+      return 7
+    if self.laser_on is None:
+      return 15
+    elapsed = time() - self.laser_on
+    stabilize, start, warmup = self.phases
+    if elapsed < stabilize:
+      return 15
+    if elapsed < stabilize + start:
+      return 13
+    if elapsed < stabilize + start + warmup:
+      return 12
+    return 8
+
+  def respond(self, command):
+    if command == 'leds?':
+      return [str(self.leds()) + '\r\n']
+    if command == 'f?':
+      return [str(self.fault) + '\r\n']
+    if command == 'cf':
+      if self.interlock:
+        self.fault = 0
+      return ['OK\r\n']
+    if command == 'l1':
+      if self.laser_on is None and self.interlock:
+        self.laser_on = time()
+      return ['OK\r\n']
+    if command == 'l0':
+      self.laser_on = None
+      return ['OK\r\n']
+    if command in ('lten1', 'xten1', '@cob 1', '@cob 0'):
+      return ['OK\r\n']
+    if command == 'sn?':
+      return [self.serial + '\r\n']
+    if command == 'wl?':
+      return [str(self.wavelength) + '\r\n']
+    return ['Syntax error: illegal command\r\n']